@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+'''
+Time taken to diff two revisions of growing pages with a few edits, with
+ukhra.lib.diff and with difflib.
+
+    $ python benchmarks/diff.py
+'''
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+import difflib
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ukhra.lib import diff
+
+
+def make_pair(lines, edits):
+    'Returns two sources of the given size differing by a few lines.'
+    rng = random.Random(lines)
+    old = [u'Line %d of the page, with %d words.' % (i, rng.randint(1, 99))
+           for i in range(lines)]
+    new = list(old)
+    for _ in range(edits):
+        index = rng.randrange(len(new))
+        if rng.random() < 0.5:
+            new[index] = u'Changed %s' % new[index]
+        else:
+            new.insert(index, u'Inserted line.')
+    return u'\n'.join(old), u'\n'.join(new)
+
+
+def timed(func, *args):
+    'Returns the seconds taken by the call.'
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def main():
+    print '%8s %12s %12s' % ('lines', 'ukhra ms', 'difflib ms')
+    for lines in (100, 1000, 10000, 50000):
+        old, new = make_pair(lines, 20)
+        ours = timed(diff.diff_texts, old, new)
+        theirs = timed(lambda: list(difflib.unified_diff(
+            old.splitlines(), new.splitlines())))
+        print '%8d %12.1f %12.1f' % (lines, ours * 1000, theirs * 1000)
+
+
+if __name__ == '__main__':
+    main()
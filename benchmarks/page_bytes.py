@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+'''
+Bytes moved from redis for one page view, with the old single JSON string
+record and with the hash record fetching only VIEW_FIELDS.
+
+    $ python benchmarks/page_bytes.py
+'''
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+import json
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ukhra.lib as mmlib
+
+
+def make_page(paragraphs):
+    'Returns a synthetic page dict with the given number of paragraphs.'
+    rawtext = u'\n\n'.join(
+        u'Paragraph %d with some *markdown* text and a [link](/page/x).' % i
+        for i in range(paragraphs))
+    return {'title': u'Benchmark page', 'rawtext': rawtext,
+            'html': mmlib.compile_text(rawtext, '0'), 'page_id': 1,
+            'version': 42, 'format': u'0', 'writer': 1,
+            'updated': u'2014-08-01 10:00', 'path': u'bench',
+            'groups': [], 'why': u'Benchmark',
+            'tags': [(u'tag%d' % i, i) for i in range(10)]}
+
+
+def main():
+    print '%12s %12s %12s %8s' % ('paragraphs', 'json bytes', 'hash bytes',
+                                  'saved')
+    for paragraphs in (1, 10, 100, 1000):
+        rpage = make_page(paragraphs)
+        old = len(json.dumps(rpage))
+        encoded = mmlib.encode_page(rpage)
+        new = sum(len(encoded[name]) for name in mmlib.VIEW_FIELDS
+                  if name in encoded)
+        print '%12d %12d %12d %7.1f%%' % (
+            paragraphs, old, new, 100.0 * (old - new) / old)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+CPU time per request and bytes on the wire for a page view sent plain,
+gzipped on every request (what a proxy does) and precompressed once.
+
+    $ python benchmarks/precompress.py
+'''
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+import gzip
+import os
+import sys
+import time
+import zlib
+from StringIO import StringIO
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+REQUESTS = 200
+
+
+def make_view(paragraphs):
+    'Returns a synthetic rendered page view of the given size.'
+    body = u''.join(
+        u'<p>Paragraph %d with some <em>markdown</em> text and a '
+        u'<a href="/page/x%d">link</a>.</p>\n' % (i, i % 7)
+        for i in range(paragraphs))
+    return (u'<!DOCTYPE html><html><head><title>Bench</title></head>'
+            u'<body><div class="main">%s</div></body></html>' % body
+            ).encode('utf-8')
+
+
+def gzip_per_request(body):
+    'Compresses like mod_deflate does, at the default level.'
+    out = StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6) as fobj:
+        fobj.write(body)
+    return out.getvalue()
+
+
+def precompressed(body):
+    'What ukhra.lib.compress_view stores once per page version.'
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def per_request_ms(func, body):
+    'Returns the milliseconds of CPU one call takes.'
+    start = time.clock()
+    for _ in range(REQUESTS):
+        func(body)
+    return (time.clock() - start) * 1000 / REQUESTS
+
+
+def main():
+    print '%10s %10s %10s %10s %12s %12s' % (
+        'plain', 'gzip -6', 'gzip -9', 'brotli', 'per req ms',
+        'stored ms')
+    for paragraphs in (10, 100, 1000, 5000):
+        body = make_view(paragraphs)
+        stored = precompressed(body)
+        br = len(brotli.compress(body)) if brotli else None
+        print '%10d %10d %10d %10s %12.3f %12.3f' % (
+            len(body), len(gzip_per_request(body)), len(stored),
+            br if br is not None else '-',
+            per_request_ms(gzip_per_request, body),
+            # Sending the stored variant is a lookup, no compression.
+            per_request_ms(lambda data: stored, body))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+'''
+Time needed to compile a synthetic set of markdown pages with a
+render.RenderPool of 1 to N worker processes.
+
+    $ python benchmarks/render_pool.py [pages]
+'''
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+import multiprocessing
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ukhra.lib import render
+
+
+def make_text(i):
+    'Returns the markdown source of the synthetic page i.'
+    return u'\n\n'.join(
+        u'## Section %d\n\nSome *text* for page %d with a [link](/page/%d).'
+        u'\n\n* one\n* two\n* three' % (j, i, j) for j in range(200))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    jobs = [(i, make_text(i), '0') for i in range(count)]
+    cpus = multiprocessing.cpu_count()
+    workers = 1
+    base = None
+    print '%8s %10s %10s %8s' % ('workers', 'seconds', 'pages/s', 'speedup')
+    while True:
+        pool = render.RenderPool(workers)
+        start = time.time()
+        for _ in pool.render(jobs, ordered=False):
+            pass
+        elapsed = time.time() - start
+        pool.close()
+        base = base or elapsed
+        print '%8d %10.2f %10.1f %7.2fx' % (
+            workers, elapsed, count / elapsed, base / elapsed)
+        if workers >= cpus:
+            break
+        workers = min(workers * 2, cpus)
+
+
+if __name__ == '__main__':
+    main()
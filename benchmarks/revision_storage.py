@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+'''
+Storage size of a page history kept as full text and as keyframes plus
+line deltas, and the time needed to rebuild a revision.
+
+    $ python benchmarks/revision_storage.py [revisions] [keyframe interval]
+'''
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ukhra.lib import revisions
+
+
+def make_history(count, lines=200):
+    'Returns the sources of count revisions, each a small edit of the last.'
+    rng = random.Random(42)
+    text = [u'Line %d of the benchmark page with some text.\n' % i
+            for i in range(lines)]
+    history = []
+    for number in range(count):
+        for _ in range(rng.randint(1, 3)):
+            index = rng.randrange(len(text))
+            action = rng.random()
+            if action < 0.6:
+                text[index] = u'Edited in revision %d.\n' % number
+            elif action < 0.8:
+                text.insert(index, u'Added in revision %d.\n' % number)
+            elif len(text) > 1:
+                del text[index]
+        history.append(u''.join(text))
+    return history
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    interval = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    history = make_history(count)
+
+    rows = []
+    previous = None
+    for number, text in enumerate(history, 1):
+        keyframe = revisions.is_keyframe(number, interval)
+        rows.append((None, revisions.encode(previous, text, keyframe),
+                     keyframe))
+        previous = text
+
+    full = sum(len(text.encode('utf-8')) for text in history)
+    stored = sum(len(row[1]) for row in rows)
+    print 'revisions:  %d, keyframe every %d' % (count, interval)
+    print 'full text:  %d bytes' % full
+    print 'delta:      %d bytes (%.1f%% of full text)' % (
+        stored, 100.0 * stored / full)
+
+    start = time.time()
+    for number in range(1, count + 1):
+        first = number - (number - 1) % interval
+        text = revisions.rebuild_text(rows[first - 1:number])
+        assert text == history[number - 1]
+    elapsed = time.time() - start
+    print 'rebuild:    %.3f ms per revision' % (1000.0 * elapsed / count)
+
+
+if __name__ == '__main__':
+    main()
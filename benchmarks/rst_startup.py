@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+Start-up cost of the reST compiler, each step measured in a new process:
+importing the module, building the compiler without and with the plugin
+index, and compiling the first page.
+
+    $ python benchmarks/rst_startup.py
+'''
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def measure(index):
+    'Prints the timings of one fresh process as: import build render.'
+    start = time.time()
+    from ukhra.lib import fakenikola
+    imported = time.time()
+    compiler = fakenikola.get_compiler(index)
+    built = time.time()
+    compiler.rst(u'Title\n=====\n\nSome *text*.')
+    rendered = time.time()
+    print imported - start, built - imported, rendered - built
+
+
+def run(index):
+    'Runs measure() in a new process and returns its timings.'
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), index], cwd=ROOT)
+    return [float(value) for value in output.split()[-3:]]
+
+
+def main():
+    index = os.path.join(tempfile.mkdtemp(), 'plugins.json')
+    print '%-22s %10s %10s %10s' % ('', 'import', 'build', 'first rst')
+    for name in ('cold (no index)', 'warm (plugin index)'):
+        timings = run(index)
+        print '%-22s %9.3fs %9.3fs %9.3fs' % tuple([name] + timings)
+    os.remove(index)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        measure(sys.argv[1])
+    else:
+        main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+Indexing throughput and query latency of the search index on synthetic
+pages. It uses redis database 15 by default, which is flushed first.
+
+    $ python benchmarks/search.py [pages] [redis db]
+'''
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from redis import Redis
+
+from ukhra.lib import search
+
+BATCH = 500
+
+
+def make_vocabulary(size=20000):
+    'Returns a list of made up words.'
+    rng = random.Random(7)
+    letters = u'abcdefghijklmnopqrstuvwxyz'
+    return [u''.join(rng.choice(letters) for _ in range(rng.randint(3, 9)))
+            for _ in range(size)]
+
+
+def make_docs(count, vocabulary):
+    'Yields synthetic (path, title, rawtext, tags) documents.'
+    rng = random.Random(42)
+    for i in range(count):
+        # Zipf like, a few words are everywhere and most are rare.
+        words = [vocabulary[int(rng.paretovariate(1.2)) % len(vocabulary)]
+                 for _ in range(rng.randint(50, 500))]
+        yield (u'page%d' % i, u' '.join(words[:4]), u' '.join(words),
+               [vocabulary[rng.randrange(50)]])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    db = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+    redis = Redis(db=db)
+    redis.flushdb()
+    vocabulary = make_vocabulary()
+
+    start = time.time()
+    batch = []
+    for doc in make_docs(count, vocabulary):
+        batch.append(doc)
+        if len(batch) == BATCH:
+            search.index_pages(redis, batch)
+            batch = []
+    search.index_pages(redis, batch)
+    elapsed = time.time() - start
+    print 'indexed %d pages in %.1fs (%.0f pages/s)' % (
+        count, elapsed, count / elapsed)
+
+    rng = random.Random(1)
+    for label, size in (('1 term', 1), ('2 terms', 2), ('3 terms', 3)):
+        timings = []
+        for _ in range(200):
+            query = u' '.join(vocabulary[int(rng.paretovariate(1.2)) % 2000]
+                              for _ in range(size))
+            begin = time.time()
+            search.search(redis, query, 0, 20, ttl=1)
+            timings.append(time.time() - begin)
+        timings.sort()
+        print '%-8s median %.2f ms, p95 %.2f ms' % (
+            label, 1000 * timings[len(timings) // 2],
+            1000 * timings[int(len(timings) * 0.95)])
+
+
+if __name__ == '__main__':
+    main()
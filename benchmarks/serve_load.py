@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''
+Load test of a running server with many concurrent keep-alive clients.
+Compare runtornado.py with and without --wsgi on the same page, with the
+view cache enabled and warm.
+
+    $ python runtornado.py --wsgi --port 5000 &
+    $ python runtornado.py --port 5001 &
+    $ python benchmarks/serve_load.py http://127.0.0.1:5000/page/help 500
+    $ python benchmarks/serve_load.py http://127.0.0.1:5001/page/help 500
+'''
+
+import sys
+import time
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+
+@gen.coroutine
+def client(url, deadline, latencies, errors):
+    'Requests the URL in a loop until the deadline.'
+    http = AsyncHTTPClient()
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            yield http.fetch(url, headers={'Accept-Encoding': 'gzip'},
+                             decompress_response=False)
+        except Exception:
+            errors.append(1)
+            continue
+        latencies.append(time.time() - start)
+
+
+@gen.coroutine
+def run(url, concurrency, duration):
+    'Runs the clients and prints the results.'
+    latencies = []
+    errors = []
+    start = time.time()
+    deadline = start + duration
+    yield [client(url, deadline, latencies, errors)
+           for _ in range(concurrency)]
+    elapsed = time.time() - start
+    latencies.sort()
+    count = len(latencies)
+    print '%d clients, %d requests, %d errors in %.1fs' % (
+        concurrency, count, len(errors), elapsed)
+    if count:
+        print '%.0f requests/s, median %.1f ms, p99 %.1f ms' % (
+            count / elapsed, 1000 * latencies[count // 2],
+            1000 * latencies[min(count - 1, int(count * 0.99))])
+
+
+def main():
+    url = sys.argv[1]
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    AsyncHTTPClient.configure(None, max_clients=concurrency)
+    IOLoop.instance().run_sync(lambda: run(url, concurrency, duration))
+
+
+if __name__ == '__main__':
+    main()
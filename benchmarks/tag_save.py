@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+'''
+Latency and number of SQL statements of saving the tags of a page with
+sync_page_tags, for a growing number of tags. Uses a scratch SQLite file.
+
+    $ python benchmarks/tag_save.py
+'''
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy as sa
+
+import ukhra.lib as mmlib
+from ukhra.lib import model
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    db_url = 'sqlite:///%s' % os.path.join(tmpdir, 'bench.sqlite')
+    session = model.create_tables(db_url)
+    statements = [0]
+
+    def count(*args, **kwargs):
+        statements[0] += 1
+    sa.event.listen(session.get_bind(), 'before_cursor_execute', count)
+
+    user = model.User(user_name='bench', email_address='bench@example.com')
+    session.add(user)
+    session.commit()
+
+    print '%6s %16s %16s %12s' % ('tags', 'new tags (ms)', 'same tags (ms)',
+                                  'statements')
+    for ntags in (1, 5, 20, 50, 100):
+        now = datetime.now()
+        page = model.Page(path='bench%d' % ntags, title='Bench', created=now,
+                          updated=now, version=0, writer=user.id)
+        session.add(page)
+        session.commit()
+        tagline = u','.join(u'tag%d-%d' % (ntags, i) for i in range(ntags))
+        results = []
+        for _ in range(2):
+            statements[0] = 0
+            start = time.time()
+            mmlib.sync_page_tags(session, page.id, tagline)
+            session.commit()
+            results.append((time.time() - start) * 1000)
+        print '%6d %16.2f %16.2f %12d' % (ntags, results[0], results[1],
+                                          statements[0])
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+'''
+Fingerprints the static files of the theme, see ukhra.lib.assets. Run it
+after changing any of them, the templates pick the new names up on the
+next restart.
+'''
+
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+from ukhra import APP
+from ukhra.lib import assets
+
+manifest = assets.build(APP.static_folder)
+for name in sorted(manifest):
+    print '%s -> %s' % (name, manifest[name])
+print '%d files fingerprinted.' % len(manifest)
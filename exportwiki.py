@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+'''
+Exports the wiki as gzip compressed JSON lines, see ukhra.lib.export.
+
+    $ python exportwiki.py backup.jsonl.gz
+    $ python exportwiki.py --since 2014-08-01 changes.jsonl.gz
+'''
+
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+import argparse
+import gzip
+import os
+import sys
+import time
+from datetime import datetime
+
+from ukhra import APP
+import ukhra.lib as mmlib
+from ukhra.lib import export
+
+
+def parse_since(value):
+    'Parses the --since date.'
+    for fmt in ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Use YYYY-MM-DD[ HH:MM]: %s' % value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports the wiki.')
+    parser.add_argument('output', help='File to write, .jsonl.gz')
+    parser.add_argument('--since', type=parse_since,
+                        help='Only export what changed since this date.')
+    parser.add_argument('--batch-size', type=int,
+                        default=APP.config.get('WARMUP_BATCH_SIZE', 500))
+    args = parser.parse_args()
+
+    session = mmlib.create_session(APP.config['DB_URL'])
+    start = time.time()
+
+    def progress(kind, counts):
+        total = sum(counts.values())
+        elapsed = time.time() - start
+        sys.stdout.write('\r%d rows, %d %ss (%.0f rows/s)   ' % (
+            total, counts.get(kind, 0), kind or 'row',
+            total / elapsed if elapsed else 0))
+        sys.stdout.flush()
+
+    # Written under another name first, a failed run leaves no archive.
+    partial = args.output + '.part'
+    out = gzip.open(partial, 'wb')
+    try:
+        counts = export.export_wiki(session, out, args.since,
+                                    args.batch_size, progress)
+    finally:
+        out.close()
+    os.rename(partial, args.output)
+    print
+    print ', '.join('%d %ss' % (counts[kind], kind)
+                    for kind in sorted(counts))
+    print 'Exported in %.1f seconds.' % (time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
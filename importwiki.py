@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+'''
+Imports pages from a directory of .md/.rst files or a MediaWiki XML dump,
+see ukhra.lib.importer. Pages which already exist are skipped, so an
+interrupted import can be run again.
+
+    $ python importwiki.py --user kushal docs/
+    $ python importwiki.py --user kushal --mediawiki dump.xml
+'''
+
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+import argparse
+import sys
+
+from ukhra import APP
+import ukhra.lib as mmlib
+from ukhra.lib import importer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Imports pages.')
+    parser.add_argument('source', help='Directory, or XML dump with '
+                        '--mediawiki.')
+    parser.add_argument('--user', required=True,
+                        help='User name the pages are written by.')
+    parser.add_argument('--mediawiki', action='store_true',
+                        help='The source is a MediaWiki XML dump.')
+    parser.add_argument('--batch-size', type=int,
+                        default=APP.config.get('WARMUP_BATCH_SIZE', 500))
+    parser.add_argument('--workers', type=int,
+                        default=APP.config.get('RENDER_WORKERS', 0),
+                        help='Render processes, 0 for one per CPU.')
+    args = parser.parse_args()
+
+    session = mmlib.create_session(APP.config['DB_URL'])
+    user = mmlib.get_user_by_username(session, args.user)
+    if not user:
+        sys.exit('No such user: %s' % args.user)
+    if args.mediawiki:
+        docs = importer.read_mediawiki(args.source)
+    else:
+        docs = importer.read_directory(args.source)
+    imported, skipped = importer.import_pages(
+        session, docs, user.id, args.batch_size, args.workers)
+    print "%d pages imported, %d skipped." % (imported, skipped)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+'''
+Compiles the pages saved while ASYNC_RENDER is enabled.
+Run as many of these as needed.
+'''
+
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+from ukhra import APP
+import ukhra.lib as mmlib
+
+SESSION = mmlib.create_session(APP.config['DB_URL'])
+mmlib.render_worker(SESSION)
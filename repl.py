@@ -44,6 +44,31 @@ class REPL(Cmd):
     def do_loadall(self, line):
         mmlib.load_all(SESSION)
 
+    def do_prunehtml(self, line):
+        'Removes the compiled HTML no page uses any more from the cache.'
+        count = mmlib.prune_render_cache(SESSION)
+        print "%s entries removed." % count
+
+    def do_convertpages(self, line):
+        'Converts the old JSON page records in redis to hashes.'
+        count = mmlib.convert_page_records()
+        print "%s pages converted." % count
+
+    def do_reindex(self, line):
+        'Rebuilds the search index from the database.'
+        count = mmlib.reindex_all(SESSION)
+        print "%s pages indexed." % count
+
+    def do_rebuildtags(self, line):
+        'Rebuilds the tag index in redis from the database.'
+        count = mmlib.rebuild_tag_index(SESSION)
+        print "%s tags indexed." % count
+
+    def do_convertrevisions(self, line):
+        'Upgrades the revision table and converts the old full text revisions.'
+        count = mmlib.convert_revisions(SESSION)
+        print "%s revisions converted." % count
+
     def do_addgroup(self, line):
         'Adds a group to the db'
         line = line.strip()
@@ -78,6 +103,7 @@ class REPL(Cmd):
         ugbase = model.UserGroup(user_id=user.id, group_id=group.id)
         SESSION.add(ugbase)
         SESSION.commit()
+        mmlib.update_user_groups(SESSION, user.id)
         print "User: %s is added to %s" % (uname, gname)
 
 
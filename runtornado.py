@@ -1,8 +1,174 @@
-from tornado.wsgi import WSGIContainer
+#!/usr/bin/env python
+'''
+Serves ukhra with Tornado.
+
+Anonymous page views are answered by a native Tornado handler: the redis
+reads run on a thread pool while the IOLoop keeps serving the other
+connections, and the body comes straight from the view cache (see
+VIEW_CACHE_ENABLED), precompressed when the client accepts it. Anything
+else (logged in users, a page not in the view cache yet, edits, history)
+falls back to the Flask application through WSGIContainer.
+
+    $ python runtornado.py --port 5000 --threads 32
+    $ python runtornado.py --wsgi      # everything through WSGIContainer
+'''
+
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+import argparse
+import calendar
+import email.utils
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.web import Application
+from tornado.web import FallbackHandler
+from tornado.web import RequestHandler
+from tornado.wsgi import WSGIContainer
+
+import ukhra
 from ukhra import APP
+import ukhra.lib as mmlib
+
+# Routes sharing the /page/ prefix with the page view.
+OTHER_PAGE_ROUTES = re.compile(
+    r'/(new|edit|history|history/\d+|diff/\d+/\d+)$')
+
+
+def accepted_encodings(header):
+    'Returns the content codings of an Accept-Encoding header.'
+    accepted = set()
+    for item in (header or '').split(','):
+        parts = item.strip().split(';')
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if parts[0] and quality > 0:
+            accepted.add(parts[0].strip().lower())
+    return accepted
+
+
+class PageHandler(RequestHandler):
+    'Anonymous views of the pages, served from the view cache.'
+
+    def initialize(self, executor, fallback):
+        self.executor = executor
+        self.fallback = fallback
+
+    def use_fallback(self):
+        'Hands the request over to the Flask application.'
+        self.fallback(self.request)
+        self._finished = True
+        self.on_finish()
+
+    def not_modified(self, etag, last_modified):
+        'Mirrors ukhra.not_modified.'
+        header = self.request.headers.get('If-None-Match')
+        if header:
+            tags = [tag.strip() for tag in header.split(',')]
+            tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+            return '*' in tags or ('"%s"' % etag) in tags
+        header = self.request.headers.get('If-Modified-Since')
+        if header and last_modified:
+            since = email.utils.parsedate_tz(header)
+            if since is None:
+                return False
+            return calendar.timegm(last_modified.timetuple()) <= \
+                email.utils.mktime_tz(since)
+        return False
+
+    def set_validators(self, etag, last_modified, encoding):
+        'Mirrors ukhra.set_validators for anonymous readers.'
+        self.set_header('ETag', '"%s"' % etag)
+        if last_modified:
+            self.set_header('Last-Modified', email.utils.formatdate(
+                calendar.timegm(last_modified.timetuple()), usegmt=True))
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('Vary', 'Cookie, Accept-Encoding')
+        if encoding:
+            self.set_header('Content-Encoding', encoding)
+
+    @gen.coroutine
+    def get(self, path):
+        # Flask sends an empty session cookie to anonymous readers too,
+        # only a cookie with a value means someone is logged in.
+        if self.get_cookie(APP.config.get('MM_COOKIE_NAME', 'MirrorManager')) \
+                or self.get_cookie(APP.session_cookie_name) \
+                or OTHER_PAGE_ROUTES.search(path) \
+                or not APP.config.get('VIEW_CACHE_ENABLED', False):
+            self.use_fallback()
+            return
+        path = path.lower()
+        page = yield self.executor.submit(
+            mmlib.find_page, path, mmlib.VIEW_FIELDS)
+        if not page:
+            self.use_fallback()
+            return
+
+        accepted = accepted_encodings(
+            self.request.headers.get('Accept-Encoding'))
+        encoding = None
+        for name in mmlib.view_encodings():
+            if name in accepted or '*' in accepted:
+                encoding = name
+                break
+        # Same ETag as the Flask view, for an anonymous reader who can not
+        # edit the page.
+        etag, last_modified = ukhra.user_page_validators(
+            page, None, 0, encoding or '')
+        if self.not_modified(etag, last_modified):
+            self.set_validators(etag, last_modified, None)
+            self.set_status(304)
+            self.finish()
+            return
+
+        body = yield self.executor.submit(
+            mmlib.get_page_view, path, ukhra.view_cache_key(page), encoding)
+        if body is None:
+            # Rendered, and cached for the next readers, by Flask.
+            self.use_fallback()
+            return
+        self.set_validators(etag, last_modified, encoding)
+        self.set_header('Content-Type', 'text/html; charset=utf-8')
+        self.finish(body)
+
+    def head(self, path):
+        self.use_fallback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves ukhra.')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=32,
+                        help='Threads doing the redis reads of page views.')
+    parser.add_argument('--wsgi', action='store_true',
+                        help='Serve everything through WSGIContainer.')
+    args = parser.parse_args()
+
+    container = WSGIContainer(APP)
+    if args.wsgi:
+        application = container
+    else:
+        executor = ThreadPoolExecutor(args.threads)
+        application = Application([
+            (r'/page/(.+)', PageHandler,
+             dict(executor=executor, fallback=container)),
+            (r'.*', FallbackHandler, dict(fallback=container)),
+        ])
+    http_server = HTTPServer(application)
+    http_server.listen(args.port)
+    IOLoop.instance().start()
+
 
-http_server = HTTPServer(WSGIContainer(APP))
-http_server.listen(5000)
-IOLoop.instance().start()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
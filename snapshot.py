@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+'''
+Writes the static snapshots of the pages changed since the last run, see
+ukhra.snapshot. SNAPSHOT_DIR must be set in the configuration.
+
+    $ python snapshot.py              # changed pages only
+    $ python snapshot.py --full       # compare every page
+    $ python snapshot.py --watch 5    # keep running, every 5 seconds
+'''
+
+# These two lines are needed to run on EL6
+__requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
+import pkg_resources
+
+import argparse
+import sys
+import time
+
+from ukhra import APP
+from ukhra import snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes page snapshots.')
+    parser.add_argument('--full', action='store_true',
+                        help='Compare every page, not only the changed ones.')
+    parser.add_argument('--watch', type=float, metavar='SECONDS',
+                        help='Keep running, waiting this long between runs.')
+    args = parser.parse_args()
+
+    root = APP.config.get('SNAPSHOT_DIR')
+    if not root:
+        sys.exit('SNAPSHOT_DIR is not set.')
+
+    if args.full:
+        start = time.time()
+        seen, count = snapshot.update_all(root)
+        print '%d pages checked, %d written in %.1f seconds.' % (
+            seen, count, time.time() - start)
+    while True:
+        start = time.time()
+        count = snapshot.update(root)
+        if count or not args.watch:
+            print '%d pages written in %.1f ms.' % (
+                count, (time.time() - start) * 1000)
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,10 +22,15 @@ Ukhra main flask controller.
 __requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
 import pkg_resources
 
+import hashlib
 import logging
 import logging.handlers
+import json
 import os
 import sys
+import time
+import urllib
+from datetime import datetime
 from pprint import pprint
 
 import flask
@@ -95,10 +100,13 @@ import ukhra
 import ukhra.lib as mmlib
 import ukhra.forms as forms
 import ukhra.lib.model as model
+from ukhra.lib import assets
 
 
 SESSION = mmlib.create_session(APP.config['DB_URL'])
 #mmlib.load_all(SESSION)
+if APP.config.get('RST_PRELOAD', False):
+    mmlib.warm_rst_compiler()
 
 
 def is_authenticated():
@@ -118,16 +126,168 @@ def login_required(function):
         return function(*args, **kwargs)
     return decorated_function
 
+def page_validators(page, *extra):
+    ''' Returns the ETag and the Last-Modified date of a view of the page.
+
+    The ETag changes with the view cache key of the page and with whoever
+    is looking at the page, as logged in users get a different navigation.
+
+    :arg page: page dict as returned by find_page.
+    :arg extra: any other value the rendered view depends on.
+    :return: tuple of the ETag and a naive UTC datetime (or None).
+    '''
+    user_id = flask.g.fas_user.id if is_authenticated() else None
+    return user_page_validators(page, user_id, *extra)
+
+
+def user_page_validators(page, user_id, *extra):
+    ''' Same as page_validators, for the given user id (None when
+    anonymous) instead of the one of the current request.
+    '''
+    # Same inputs as the view cache, so a new theme, template or asset
+    # build changes the ETag too.
+    parts = [page['page_id'], view_cache_key(page)]
+    if user_id is not None:
+        parts.append('u%s' % user_id)
+    parts.extend(extra)
+    etag = '-'.join(str(part) for part in parts)
+    try:
+        updated = datetime.strptime(page['updated'], mmlib.UPDATED_FORMAT)
+        updated = datetime.utcfromtimestamp(time.mktime(updated.timetuple()))
+    except (KeyError, ValueError):
+        # Records written before the seconds were kept are too coarse, a
+        # second edit within the same minute would look unmodified.
+        updated = None
+    return etag, updated
+
+
+def set_validators(response, etag, last_modified):
+    ''' Adds the ETag, Last-Modified and caching headers to the response.
+
+    A response showing flashed messages gets no validators, the messages
+    must not come back from the browser cache on the next visit.
+    '''
+    if getattr(flask.g, 'flashes_shown', False):
+        response.cache_control.no_store = True
+    else:
+        response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    if is_authenticated():
+        response.cache_control.private = True
+    response.vary.add('Cookie')
+    return response
+
+
+def not_modified(etag, last_modified):
+    ''' Returns a 304 response if the client already holds the current
+    version of the resource, None otherwise.
+
+    If-None-Match takes precedence over If-Modified-Since.
+    '''
+    if '_flashes' in flask.session:
+        # The flashed messages are only shown on a full render, see
+        # set_validators.
+        flask.g.flashes_shown = True
+        return None
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified:
+        since = request.if_modified_since
+        if since.tzinfo is not None:
+            since = since.replace(tzinfo=None) - since.utcoffset()
+        fresh = last_modified <= since
+    else:
+        return None
+    if not fresh:
+        return None
+    return set_validators(flask.Response(status=304), etag, last_modified)
+
+
+def view_cache_key(page):
+    ''' Returns the key of the rendered view of the page in the view cache.
+
+    The key changes with the page version, with the templates and with the
+    built static files in use.
+    '''
+    return '%s%s:%s:%s:%s:%s' % (
+        page.get('version', 0), 'p' if page.get('render_pending') else '',
+        APP.config['THEME_FOLDER'], APP.config.get('VIEW_CACHE_VERSION', 1),
+        __version__, ASSETS_KEY)
+
+
+def use_view_cache():
+    ''' Returns whether the rendered view can be shared with everyone.
+
+    Logged in users get their own navigation and edit controls, so only
+    anonymous views without any flashed message are cached.
+    '''
+    return APP.config.get('VIEW_CACHE_ENABLED', False) \
+        and not is_authenticated() and '_flashes' not in flask.session
+
+
+def preferred_encoding():
+    ''' Returns the best content coding of the cached views accepted by
+    the client, or None for the plain HTML.
+    '''
+    for encoding in mmlib.view_encodings():
+        if request.accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+def vary_encoding(response, cached):
+    ''' Adds Accept-Encoding to the Vary header of a cached view.
+    '''
+    if cached:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def encoded_response(body, encoding):
+    ''' Returns the response for a precompressed (or plain) cached view.
+    '''
+    response = flask.make_response(body)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return vary_encoding(response, True)
+
+
 # # Flask application
 
+# Fingerprinted names of the static files, see buildassets.py
+ASSETS = assets.load_manifest(APP.static_folder)
+ASSETS_KEY = hashlib.sha1(
+    json.dumps(ASSETS, sort_keys=True)).hexdigest()[:8] if ASSETS else ''
+
+
+def asset_url(filename):
+    ''' Returns the URL of a static file, fingerprinted if it was built.
+    '''
+    return flask.url_for('static', filename=ASSETS.get(filename, filename))
+
+
 @APP.context_processor
 def inject_variables():
     """ Inject some variables into every template.
     """
     return dict(
-        version=__version__
+        version=__version__,
+        asset_url=asset_url
     )
 
+
+@APP.after_request
+def cache_assets(response):
+    ''' Fingerprinted static files never change, let browsers keep them.
+    '''
+    if response.status_code in (200, 304) and request.path.startswith(
+            '%s/%s/' % (APP.static_url_path, assets.DIST)):
+        response.headers['Cache-Control'] = \
+            'public, max-age=31536000, immutable'
+    return response
+
 @APP.route('/')
 def index():
     """ Displays the index page.
@@ -142,20 +302,148 @@ def pages(path):
     'Displays a particular page or opens the editor for a new page.'
     path = path.lower()
     edit = False
-    page = mmlib.find_page(path)
+    page = mmlib.find_page(path, mmlib.VIEW_FIELDS)
     if is_authenticated() and page:
         edit = check_group_perm(page)
     if not page:
         # We should showcase the editor here.
         return flask.redirect(flask.url_for('newpages', path=path))
     else:
-        return flask.render_template(
+        cached = use_view_cache()
+        # Each coding is its own representation, with its own ETag.
+        encoding = preferred_encoding() if cached else None
+        etag, last_modified = page_validators(page, int(edit), encoding or '')
+        response = not_modified(etag, last_modified)
+        if response:
+            return vary_encoding(response, cached)
+        if cached:
+            key = view_cache_key(page)
+            body = mmlib.get_page_view(path, key, encoding)
+            if body:
+                response = encoded_response(body, encoding)
+                return set_validators(response, etag, last_modified)
+        body = flask.render_template(
             'viewpage.html',
             page=page,
             path=path,
             editpage=edit
 
         )
+        if cached:
+            body = body.encode('utf-8')
+            variants = mmlib.set_page_view(path, key, body)
+            if encoding:
+                body = variants[encoding]
+            response = encoded_response(body, encoding)
+        else:
+            response = flask.make_response(body)
+        return set_validators(response, etag, last_modified)
+
+
+@APP.route('/search')
+def searchpages():
+    'Displays the pages matching the query.'
+    query = request.args.get('q', u'').strip()
+    number = max(request.args.get('page', 1, type=int), 1)
+    total, hits = 0, []
+    if query:
+        total, hits = mmlib.search_pages(query, number)
+    limit = APP.config.get('ITEMS_PER_PAGE', 50)
+    return flask.render_template(
+        'search.html',
+        query=query,
+        total=total,
+        hits=hits,
+        number=number,
+        more=number * limit < total
+    )
+
+
+@APP.route('/tag/<names>')
+def tagpages(names):
+    'Lists the pages having all the tags, given as tag1+tag2.'
+    names = [name for name in names.split('+') if name]
+    number = max(request.args.get('page', 1, type=int), 1)
+    total, pages = mmlib.get_tagged_pages(names, number)
+    limit = APP.config.get('ITEMS_PER_PAGE', 50)
+    return flask.render_template(
+        'tag.html',
+        names=names,
+        total=total,
+        tagged=pages,
+        number=number,
+        more=number * limit < total
+    )
+
+
+def recent_validators(*extra):
+    ''' Returns the ETag and the Last-Modified date of the recent changes.
+
+    Both only depend on the time of the latest change, so they are known
+    without reading the changes themselves.
+    '''
+    newest = mmlib.last_change()
+    parts = ['recent', repr(newest), __version__]
+    if is_authenticated():
+        parts.append('u%s' % flask.g.fas_user.id)
+    parts.extend(extra)
+    etag = '-'.join(str(part) for part in parts)
+    if newest is None:
+        return etag, None
+    return etag, datetime.utcfromtimestamp(int(newest))
+
+
+@APP.route('/recent')
+def recentpages():
+    'Lists the latest changed pages.'
+    before = request.args.get('before', type=float)
+    after = request.args.get('after')
+    etag, last_modified = recent_validators(
+        'html', before, urllib.quote(after.encode('utf-8')) if after else None)
+    response = not_modified(etag, last_modified)
+    if response:
+        return response
+    changes, older = mmlib.get_recent_changes(before, after)
+    response = flask.make_response(flask.render_template(
+        'recent.html',
+        changes=changes,
+        older=older
+    ))
+    return set_validators(response, etag, last_modified)
+
+
+@APP.route('/recent.atom')
+def recentfeed():
+    'Atom feed of the latest changed pages.'
+    etag, last_modified = recent_validators('atom')
+    response = not_modified(etag, last_modified)
+    if response:
+        return response
+    changes, _ = mmlib.get_recent_changes()
+    response = flask.make_response(flask.render_template(
+        'recent.xml',
+        changes=changes,
+        updated=changes[0]['updated'] if changes else datetime.utcnow()
+    ))
+    response.mimetype = 'application/atom+xml'
+    return set_validators(response, etag, last_modified)
+
+
+def is_admin():
+    '''Returns True if the user is in one of the ADMIN_GROUP groups.'''
+    if not is_authenticated():
+        return False
+    ugroups = mmlib.get_user_groups(SESSION, flask.g.fas_user.id)
+    return not ugroups.isdisjoint(APP.config.get('ADMIN_GROUP', ()))
+
+
+@APP.route('/stats/pagecache')
+@login_required
+def pagecache_stats():
+    'Returns the counters of the page cache of this worker as JSON.'
+    if not is_admin():
+        flask.abort(403)
+    return flask.jsonify(mmlib.page_cache_stats())
 
 
 @APP.route('/page/<path:path>/new', methods=['POST','GET'])
@@ -172,7 +460,7 @@ def newpages(path):
         else:
             return flask.redirect(flask.url_for('index'))
     else:
-        page = mmlib.find_page(path)
+        page = mmlib.find_page(path, mmlib.VIEW_FIELDS)
         if not page:
             # We should showcase the editor here.
             return flask.render_template(
@@ -190,16 +478,13 @@ def newpages(path):
 
 def check_group_perm(page):
     '''Returns True or False'''
-    pgroups = page.get('groups', [])
-    if pgroups:
-        set1 = set(pgroups)
-        try:
-            set2 = set(flask.g.fas_user.groups)
-        except:
-            set2 = ()
-        if not set1.intersection(set2):
-            return False
-    return True
+    pgroups = page.get('groups')
+    if not pgroups:
+        return True
+    if not is_authenticated():
+        return False
+    ugroups = mmlib.get_user_groups(SESSION, flask.g.fas_user.id)
+    return not pgroups.isdisjoint(ugroups)
 
 
 @APP.route('/page/<path:path>/edit', methods=['POST','GET'])
@@ -253,7 +538,8 @@ def editpages(path):
 @login_required
 def historypages(path):
     path = path.lower()
-    page = mmlib.find_page(path)
+    page = mmlib.find_page(
+        path, ('page_id', 'version', 'updated', 'groups', 'path'))
     if not page: # WHen the page is missing
         return flask.redirect(flask.url_for('newpages', path=path))
     # Now see if the user has access rights for this page groups.
@@ -261,14 +547,72 @@ def historypages(path):
         return flask.render_template(
                 'noperm.html')
     if request.method == 'GET':
-        history = mmlib.get_page_revisions(SESSION, path)
-        return flask.render_template(
+        before = request.args.get('before', type=int)
+        after = request.args.get('after', type=int)
+        etag, last_modified = page_validators(page, 'history', before, after)
+        response = not_modified(etag, last_modified)
+        if response:
+            return response
+        history, newer, older = mmlib.get_page_revisions(
+            SESSION, path, before=before, after=after)
+        response = flask.make_response(flask.render_template(
                         'history.html',
                         path=path,
                         edit='True',
                         page=page,
-                        history=history
-                    )
+                        history=history,
+                        newer=newer,
+                        older=older
+                    ))
+        return set_validators(response, etag, last_modified)
+
+
+@APP.route('/page/<path:path>/history/<int:revision>')
+@login_required
+def revisionpages(path, revision):
+    path = path.lower()
+    page = mmlib.find_page(path, ('page_id', 'groups', 'path'))
+    if not page: # WHen the page is missing
+        return flask.redirect(flask.url_for('newpages', path=path))
+    if not check_group_perm(page):
+        return flask.render_template(
+                'noperm.html')
+    rev = mmlib.get_revision(SESSION, path, revision)
+    if not rev:
+        flask.abort(404)
+    return flask.render_template(
+                    'revision.html',
+                    path=path,
+                    page=page,
+                    rev=rev
+                )
+
+
+@APP.route('/page/<path:path>/diff/<int:old>/<int:new>')
+@login_required
+def diffpages(path, old, new):
+    path = path.lower()
+    page = mmlib.find_page(path, ('page_id', 'groups', 'path'))
+    if not page: # WHen the page is missing
+        return flask.redirect(flask.url_for('newpages', path=path))
+    if not check_group_perm(page):
+        return flask.render_template(
+                'noperm.html')
+    result = mmlib.get_revision_diff(SESSION, path, old, new)
+    if not result:
+        flask.abort(404)
+    if request.args.get('format') == 'json':
+        body = json.dumps(
+            {'old': old, 'new': new, 'hunks': result['hunks']},
+            separators=(',', ':'))
+        return flask.Response(body, mimetype='application/json')
+    return flask.render_template(
+                    'diff.html',
+                    path=path,
+                    page=page,
+                    diff=result,
+                    rows=mmlib.diff.to_html(result['hunks'])
+                )
 
 
 
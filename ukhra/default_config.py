@@ -84,3 +84,153 @@ APPLICATION_URL = None
 # under certain setup it might not work (for example is there are proxies
 # in front of the application).
 CHECK_SESSION_IP = False
+
+
+# Keep recently viewed pages in the memory of every worker process, in
+# front of redis. Changes are broadcast on PAGE_CACHE_CHANNEL so that all
+# the processes drop their stale copies.
+# Default: ``False``.
+PAGE_CACHE_ENABLED = False
+
+# Maximum number of pages kept in the cache of each worker.
+# Default: ``1000``.
+PAGE_CACHE_ENTRIES = 1000
+
+# Maximum size in bytes of the cached pages of each worker.
+# Default: ``64 MB``.
+PAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+# Maximum number of users whose groups are kept in the memory of each
+# worker, to check the page permissions.
+# Default: ``10000``.
+GROUP_CACHE_ENTRIES = 10000
+
+# Redis pub/sub channel used to invalidate the cached pages and groups.
+# Default: ``ukhra:invalidate``.
+PAGE_CACHE_CHANNEL = 'ukhra:invalidate'
+
+# Cache the rendered page views of anonymous readers in redis.
+# Default: ``False``.
+VIEW_CACHE_ENABLED = False
+
+# Number of seconds a rendered page view is kept in redis.
+# Default: ``3600``.
+VIEW_CACHE_TTL = 3600
+
+# Bump this whenever the templates change, so that the rendered page views
+# cached in redis are not used any more.
+# Default: ``1``.
+VIEW_CACHE_VERSION = 1
+
+# Number of pages read from the database and written to redis at once by
+# load_all.
+# Default: ``500``.
+WARMUP_BATCH_SIZE = 500
+
+# Number of processes compiling the pages in bulk jobs like load_all.
+# ``0`` means one process per CPU, ``1`` compiles in the calling process.
+# Default: ``0``.
+RENDER_WORKERS = 0
+
+# Compiled HTML is cached in redis by a hash of the source and of the
+# renderer version. Bump this to throw the whole render cache away.
+# Default: ``1``.
+RENDER_CACHE_VERSION = 1
+
+# File caching which Nikola plugins are reST extensions, so that new worker
+# processes do not need to scan and import every plugin. It is rebuilt
+# when Nikola or the plugin directories change. ``None`` disables it.
+# The index decides which modules are imported, so keep it in a directory
+# only the application can write to, for example
+# ``/var/lib/ukhra/rst_plugins.json``, never in a shared one like /tmp.
+# Default: ``None``.
+RST_PLUGIN_INDEX = None
+
+# Build the reST compiler when the application is imported instead of on
+# the first reST page. Useful with preforking servers loading the
+# application before forking, as the workers then share the compiler.
+# Default: ``False``.
+RST_PRELOAD = False
+
+# Save the page source right away and compile it on a background worker
+# (see renderworker.py) instead of inside the request. Readers see the
+# previous HTML until the new one is ready.
+# Default: ``False``.
+ASYNC_RENDER = False
+
+# Where the sessions of the `local` authentication are kept, either `sql`
+# or `redis`. With `redis` a logged in request does not query the database.
+# Default: ``sql``.
+SESSION_BACKEND = 'sql'
+
+# With the `redis` session backend, also record the sessions in the
+# database so that they survive a loss of the redis data.
+# Default: ``True``.
+SESSION_SQL_AUDIT = True
+
+# With the `redis` session backend, the expiry of a session is only pushed
+# back once this fraction of PERMANENT_SESSION_LIFETIME has passed.
+# Default: ``0.25``.
+SESSION_REFRESH_FRACTION = 0.25
+
+# Record the redis updates and notifications of a page change in the
+# outbox table, in the same transaction as the change, instead of running
+# them in the request. outboxworker.py must be running to dispatch them.
+# Default: ``False``.
+OUTBOX_ENABLED = False
+
+# Number of outbox entries dispatched at once.
+# Default: ``100``.
+OUTBOX_BATCH_SIZE = 100
+
+# Number of times a failing outbox entry is tried before giving up.
+# Default: ``10``.
+OUTBOX_MAX_ATTEMPTS = 10
+
+# Seconds the outbox worker waits when there is nothing to dispatch.
+# Default: ``1``.
+OUTBOX_POLL_INTERVAL = 1
+
+# Revisions are stored as a compressed line delta against the previous
+# revision, with the full source kept every this many revisions. Higher
+# values save space, lower ones make viewing old revisions faster.
+# Default: ``20``.
+REVISION_KEYFRAME_INTERVAL = 20
+
+# Number of changed lines after which the diff of two revisions uses
+# difflib instead of the Myers algorithm, bounding the time spent on
+# rewritten pages.
+# Default: ``1000``.
+DIFF_MAX_EDITS = 1000
+
+# Seconds a computed diff of two revisions is kept in redis.
+# Default: ``86400``.
+DIFF_CACHE_TTL = 86400
+
+# Seconds the full result of a search is kept in redis, so that the next
+# pages of results do not run the query again. New edits show up in the
+# results of the same query after at most this long.
+# Default: ``30``.
+SEARCH_RESULT_TTL = 30
+
+# Seconds the intersection of several tags (/tag/a+b) is kept in redis
+# for the next pages of the listing.
+# Default: ``30``.
+TAG_RESULT_TTL = 30
+
+# Number of pages kept in the recent changes, older changes are dropped.
+# Default: ``1000``.
+RECENT_CHANGES_LIMIT = 1000
+
+# Directory of the static snapshots of the pages written by snapshot.py,
+# for the web server to send to anonymous readers (see
+# utilities/ukhra.conf). When set, changed pages are tracked for the next
+# run. ``None`` disables the snapshots.
+# Default: ``None``.
+SNAPSHOT_DIR = None
+
+# zlib level of the gzip variant of the cached page views. They are only
+# compressed once per page version, so the default is the smallest output.
+# A brotli variant is stored too when the brotli module is installed.
+# Default: ``9``.
+VIEW_GZIP_LEVEL = 9
@@ -21,6 +21,7 @@ Ukhra internal api.
 __requires__ = ['SQLAlchemy >= 0.7', 'jinja2 >= 2.4']
 import pkg_resources
 
+import cgi
 import datetime
 import random
 import string
@@ -36,26 +37,51 @@ logger = logging.getLogger(__name__)
 
 
 from redis import Redis
+from redis.exceptions import ResponseError
+from redis.exceptions import WatchError
 redis = Redis()
 
 import os
+import threading
+import time
+import zlib
 import sqlalchemy
 
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
 
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
 
 from ukhra.lib import model
 from ukhra.lib import notifications
+from ukhra.lib import cache
+from ukhra.lib import render
+from ukhra.lib import sessions
+from ukhra.lib import fakenikola
+from ukhra.lib import diff
+from ukhra.lib import revisions
+from ukhra.lib import search
 from ukhra import default_config
 import markdown
-#from fakenikola import RSTCompiler
 
-#COMPILER = RSTCompiler()
+PAGE_CACHE = None
+GROUP_CACHE = None
+_PAGE_CACHE_PID = None
+_PAGE_CACHE_LOCK = threading.Lock()
+
 
+def _config(name, default=None):
+    '''Returns the value of the given configuration key.'''
+    import ukhra
+    return ukhra.APP.config.get(name, default)
 
 
 def create_session(db_url, debug=False, pool_recycle=3600):
@@ -149,6 +175,119 @@ def get_session_by_visitkey(session, sessionid):
 
     return query.first()
 
+def _timestamp(value):
+    '''Returns the naive local datetime as seconds since the epoch.'''
+    return time.mktime(value.timetuple())
+
+
+def store_visit(visit_key, user, user_ip, expiry):
+    '''Stores the session in redis, it expires along with the session.
+
+    :param visit_key: Session identifier.
+    :param user: model.User object
+    :param user_ip: IP address the user logged in from.
+    :param expiry: datetime at which the session expires.
+    :return: None
+    '''
+    key = 'visit:%s' % visit_key
+    visit = {'user_id': user.id, 'user_name': user.user_name,
+             'display_name': user.display_name,
+             'email_address': user.email_address,
+             'user_ip': user_ip, 'expiry': _timestamp(expiry)}
+    pipe = redis.pipeline()
+    pipe.set(key, json.dumps(visit))
+    pipe.expireat(key, int(visit['expiry']) + 1)
+    pipe.execute()
+
+
+def get_visit(visit_key):
+    '''Returns the session stored in redis.
+
+    :param visit_key: Session identifier.
+    :return: dict of the session, or None if it is missing or expired.
+    '''
+    data = redis.get('visit:%s' % visit_key)
+    if not data:
+        return None
+    visit = json.loads(data)
+    if visit['expiry'] < time.time():
+        return None
+    return visit
+
+
+def restore_visit(session, visit_key):
+    '''Copies a session still valid in the database back to redis.
+
+    This is only needed after redis lost its data.
+
+    :param session: database connection object
+    :param visit_key: Session identifier.
+    :return: dict of the session or None.
+    '''
+    visit = get_session_by_visitkey(session, visit_key)
+    if not visit or not visit.expiry or visit.expiry < datetime.now():
+        return None
+    store_visit(visit_key, visit.user, visit.user_ip, visit.expiry)
+    return get_visit(visit_key)
+
+
+def refresh_visit(session, visit_key, visit, lifetime, fraction=0.25,
+                  audit=True):
+    '''Slides the expiry of the session.
+
+    To keep writes rare the expiry is only pushed back once the given
+    fraction of the lifetime has passed since the last time.
+
+    :param session: database connection object
+    :param visit_key: Session identifier.
+    :param visit: dict of the session, as returned by get_visit.
+    :param lifetime: timedelta the session lives for.
+    :param fraction: fraction of the lifetime after which it is extended.
+    :param audit: if True, the expiry is also written to the database.
+    :return: Boolean, True if the session was extended.
+    '''
+    seconds = lifetime.days * 86400 + lifetime.seconds
+    now = time.time()
+    if visit['expiry'] - now > seconds * (1 - fraction):
+        return False
+    expiry = datetime.now() + lifetime
+    visit['expiry'] = _timestamp(expiry)
+    key = 'visit:%s' % visit_key
+    pipe = redis.pipeline()
+    pipe.set(key, json.dumps(visit))
+    pipe.expireat(key, int(visit['expiry']) + 1)
+    pipe.execute()
+    if audit:
+        session.query(model.UserVisit).filter(
+            model.UserVisit.visit_key == visit_key
+        ).update({'expiry': expiry}, synchronize_session=False)
+        try:
+            session.commit()
+        except SQLAlchemyError, err:
+            session.rollback()
+            logger.error(err)
+    return True
+
+
+def delete_visit(session, visit_key):
+    '''Removes the session from redis and expires it in the database, so
+    that restore_visit cannot bring it back.
+
+    :param session: database connection object
+    :param visit_key: Session identifier.
+    :return: None
+    '''
+    redis.delete('visit:%s' % visit_key)
+    session.query(model.UserVisit).filter(
+        model.UserVisit.visit_key == visit_key
+    ).update({'expiry': datetime.now()}, synchronize_session=False)
+    try:
+        session.commit()
+    except SQLAlchemyError, err:
+        session.rollback()
+        logger.error(err)
+
+
 def id_generator(size=15, chars=string.ascii_uppercase + string.digits):
     """ Generates a random identifier for the given size and using the
     specified characters.
@@ -162,52 +301,1026 @@ def id_generator(size=15, chars=string.ascii_uppercase + string.digits):
     return ''.join(random.choice(chars) for x in range(size))
 
 
-def find_page(path):
-    'Finds the page from the given path'
-    data = redis.get('page:%s' % path)
-    if data:
-        return json.loads(data)
+def _start_local_caches():
+    '''Creates the in-process caches of this worker.
+
+    The caches and their invalidation listener are created on first use in
+    every process, so that forked workers do not share them.
+    '''
+    global PAGE_CACHE, GROUP_CACHE, _PAGE_CACHE_PID
+    if _PAGE_CACHE_PID == os.getpid():
+        return
+    with _PAGE_CACHE_LOCK:
+        if _PAGE_CACHE_PID != os.getpid():
+            PAGE_CACHE = cache.PageCache(
+                _config('PAGE_CACHE_ENTRIES', 1000),
+                _config('PAGE_CACHE_BYTES', 64 * 1024 * 1024))
+            GROUP_CACHE = cache.PageCache(
+                _config('GROUP_CACHE_ENTRIES', 10000), 16 * 1024 * 1024)
+            listener = threading.Thread(
+                target=cache.listen,
+                args=(redis, _config('PAGE_CACHE_CHANNEL', 'ukhra:invalidate'),
+                      {'page': PAGE_CACHE, 'usergroups': GROUP_CACHE}))
+            listener.daemon = True
+            listener.start()
+            _PAGE_CACHE_PID = os.getpid()
+
+
+def get_page_cache():
+    '''Returns the in-process page cache of this worker.
+
+    :return: cache.PageCache object or None if the cache is disabled.
+    '''
+    if not _config('PAGE_CACHE_ENABLED', False):
+        return None
+    _start_local_caches()
+    return PAGE_CACHE
+
+
+def get_user_groups(session, user_id):
+    '''Returns the names of the groups of the user.
+
+    They are looked up in the memory of this process, then in the redis
+    hash 'usergroups' and only then in the database.
+    update_user_groups must be called whenever the membership changes.
+
+    :param session: database connection object
+    :param user_id: id of the user
+    :return: frozenset of group names
+    '''
+    _start_local_caches()
+    groups = GROUP_CACHE.get(user_id)
+    if groups is not None:
+        return groups
+    generation = GROUP_CACHE.generation
+    data = redis.hget('usergroups', user_id)
+    if data is None:
+        data = json.dumps(_query_user_groups(session, user_id))
+        # Only update_user_groups overwrites, what we read might be older.
+        if not redis.hsetnx('usergroups', user_id, data):
+            data = redis.hget('usergroups', user_id) or data
+    groups = frozenset(json.loads(data))
+    GROUP_CACHE.put(user_id, groups, len(data), generation)
+    return groups
+
+
+def _query_user_groups(session, user_id):
+    '''Returns the sorted group names of the user from the database.'''
+    query = session.query(
+        model.Group.group_name
+    ).join(
+        model.UserGroup, model.UserGroup.group_id == model.Group.id
+    ).filter(
+        model.UserGroup.user_id == user_id
+    )
+    return sorted(name for name, in query)
+
+
+def update_user_groups(session, user_id):
+    '''Refreshes the cached groups of the user in every process.
+
+    :param session: database connection object
+    :param user_id: id of the user
+    :return: None
+    '''
+    redis.hset('usergroups', user_id,
+               json.dumps(_query_user_groups(session, user_id)))
+    if GROUP_CACHE is not None:
+        GROUP_CACHE.invalidate(user_id)
+    redis.publish(_config('PAGE_CACHE_CHANNEL', 'ukhra:invalidate'),
+                  'usergroups:%s' % user_id)
+
+
+def page_cache_stats():
+    '''Returns the counters of the in-process page cache.
+
+    :return: dict of counters, empty if the cache is disabled.
+    '''
+    pcache = get_page_cache()
+    if pcache is None:
+        return {}
+    stats = pcache.stats()
+    stats['pid'] = os.getpid()
+    return stats
+
+
+def invalidate_page(path):
+    '''Drops the page from the in-process caches of every worker, and marks
+    its static snapshot as out of date.
+
+    :param path: Path of the page.
+    :return: None
+    '''
+    pcache = get_page_cache()
+    if pcache is not None:
+        pcache.invalidate(path)
+    clear_page_view(path)
+    if _config('SNAPSHOT_DIR', None):
+        # Written again by the next run of snapshot.py
+        redis.sadd('snapshot:dirty', path)
+    redis.publish(_config('PAGE_CACHE_CHANNEL', 'ukhra:invalidate'),
+                  'page:%s' % path)
+
+
+def view_encodings():
+    '''Returns the content codings of the cached views, best first.'''
+    if brotli is not None:
+        return ('br', 'gzip')
+    return ('gzip',)
+
+
+def compress_view(body):
+    '''Returns the compressed variants of a rendered view.
+
+    This runs once per version of a page, so the best compression level is
+    worth its CPU time.
+
+    :param body: utf-8 encoded HTML.
+    :return: dict of content coding and compressed bytes.
+    '''
+    # A wbits of 31 writes a gzip header, with a zero timestamp so that the
+    # same page always gives the same bytes.
+    compressor = zlib.compressobj(
+        _config('VIEW_GZIP_LEVEL', 9), zlib.DEFLATED, 31)
+    variants = {'gzip': compressor.compress(body) + compressor.flush()}
+    if brotli is not None:
+        variants['br'] = brotli.compress(body)
+    return variants
+
+
+def get_page_view(path, key, encoding=None):
+    '''Returns the cached rendered view of the page.
+
+    :param path: Path of the page.
+    :param key: Version key of the view, see ukhra.view_cache_key.
+    :param encoding: Content coding of the body, one of view_encodings(),
+        or None for the plain HTML.
+    :return: utf-8 encoded (and compressed) HTML or None.
+    '''
+    if encoding:
+        key = '%s:%s' % (key, encoding)
+    return redis.hget('view:%s' % path, key)
+
+
+def set_page_view(path, key, body):
+    '''Stores the rendered view of the page and its compressed variants in
+    redis.
+
+    All the views of a page are kept in one hash, so that they expire and
+    get cleared together.
+
+    :param path: Path of the page.
+    :param key: Version key of the view, see ukhra.view_cache_key.
+    :param body: utf-8 encoded HTML.
+    :return: dict of content coding and compressed bytes.
+    '''
+    variants = compress_view(body)
+    fields = {key: body}
+    for encoding, data in variants.iteritems():
+        fields['%s:%s' % (key, encoding)] = data
+    pipe = redis.pipeline()
+    pipe.hmset('view:%s' % path, fields)
+    pipe.expire('view:%s' % path, _config('VIEW_CACHE_TTL', 3600))
+    pipe.execute()
+    return variants
+
+
+def clear_page_view(path):
+    '''Removes all the cached rendered views of the page.
+
+    :param path: Path of the page.
+    :return: None
+    '''
+    redis.delete('view:%s' % path)
+
+
+# Every page is stored in redis as a hash at page:<path>, so that a view
+# can fetch only the fields it needs. These fields are stored JSON
+# encoded, the others as utf-8 text.
+PAGE_JSON_FIELDS = ('page_id', 'version', 'writer', 'groups', 'tags',
+                    'render_pending')
+PAGE_FIELDS = ('title', 'rawtext', 'html', 'format', 'updated', 'path',
+               'why') + PAGE_JSON_FIELDS
+# Fields needed to display a page.
+VIEW_FIELDS = ('title', 'html', 'tags', 'page_id', 'version', 'updated',
+               'groups', 'path', 'render_pending')
+# Format of the updated field, with the seconds as it is also used for
+# the Last-Modified header. Older records only have the minutes.
+UPDATED_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def encode_page(rpage):
+    '''Encodes the page dict into the values of the redis hash.
+
+    :param rpage: page dict
+    :return: dict of field name and encoded value.
+    '''
+    result = {}
+    for name, value in rpage.items():
+        if value is None:
+            continue
+        if isinstance(value, (set, frozenset)):
+            result[name] = json.dumps(sorted(value))
+        elif name in PAGE_JSON_FIELDS:
+            result[name] = json.dumps(value)
+        elif isinstance(value, unicode):
+            result[name] = value.encode('utf-8')
+        else:
+            result[name] = str(value)
+    return result
+
+
+def decode_page_field(name, value):
+    '''Decodes one value of the redis hash.
 
-def load_all(session):
-    'Loads all pages to the redis.'
-    query = session.query(model.Page)
-    for page in query:
-        if not page.format:
-            format = '0'
+    :param name: Name of the field.
+    :param value: Value as returned by redis, can be None.
+    :return: Decoded value or None.
+    '''
+    if value is None:
+        return None
+    if name == 'groups':
+        # Ready to be intersected with the groups of the user.
+        return frozenset(json.loads(value))
+    if name in PAGE_JSON_FIELDS:
+        return json.loads(value)
+    return value.decode('utf-8')
+
+
+def fetch_page(path, fields=None):
+    '''Fetches the page fields from redis, skipping the in-process cache.
+
+    :param path: Path of the page.
+    :param fields: List of field names, None for every field.
+    :return: tuple of the dict of decoded fields (missing fields are set to
+        None) and the number of bytes read, or (None, 0) if there is no
+        such page.
+    '''
+    key = 'page:%s' % path
+    try:
+        if fields is None:
+            fields = PAGE_FIELDS
+            raw = redis.hgetall(key)
+            values = [raw.get(name) for name in fields]
         else:
-            format = '1'
-        g = []
-        try:
-            g = page.groups
-        except:
-            pass # we do not care for now.
-
-        rpage = {'title': page.title, 'rawtext':page.data, 'html': compile_text(page.data, format), 'page_id': page.id,
-            'writer': page.writer, 'updated' : page.updated.strftime('%Y-%m-%d %H:%M'),
-            'path': page.path, 'groups': g, 'tags': page.tags}
-        redis.set('page:%s' % page.path, json.dumps(rpage))
-        redis.lpush('latestpages', page.path)
+            values = redis.hmget(key, fields)
+    except ResponseError:
+        # Not converted yet, see convert_page_records
+        data = redis.get(key)
+        if not data:
+            return None, 0
+        raw = encode_page(json.loads(data))
+        fields = PAGE_FIELDS if fields is None else fields
+        values = [raw.get(name) for name in fields]
+    if not any(value is not None for value in values):
+        return None, 0
+    size = sum(len(value) for value in values if value is not None)
+    return dict((name, decode_page_field(name, value))
+                for name, value in zip(fields, values)), size
+
+
+def find_page(path, fields=None):
+    '''Finds the page from the given path
+
+    :param path: Path of the page.
+    :param fields: List of the fields needed, default is all of them.
+        Views should only ask for what they show, for example VIEW_FIELDS.
+    :return: dict of the page fields or None.
+    '''
+    pcache = get_page_cache()
+    if pcache is None:
+        page, _ = fetch_page(path, fields)
+    else:
+        wanted = PAGE_FIELDS if fields is None else fields
+        # Read before the cache, so that the fields cached before an
+        # invalidation are never stored under the newer generation.
+        generation = pcache.generation
+        page = pcache.get(path)
+        if page is None or not all(name in page for name in wanted):
+            cached = page or {}
+            page, size = fetch_page(path, fields)
+            if page is not None:
+                for name, value in cached.items():
+                    if name not in page:
+                        page[name] = value
+                        size += len(encode_page({name: value}).get(name, ''))
+                pcache.put(path, page, size, generation)
+    if page is None:
+        return None
+    return dict((name, value) for name, value in page.items()
+                if value is not None and (fields is None or name in fields))
+
+
+def store_page(pipe, rpage):
+    '''Queues the writes of the whole page record on a redis pipeline.
+
+    :param pipe: Redis pipeline.
+    :param rpage: page dict, must have the path.
+    :return: None
+    '''
+    key = 'page:%s' % rpage['path']
+    pipe.delete(key)
+    pipe.hmset(key, encode_page(rpage))
+
+
+def convert_page_records():
+    '''Converts the old JSON string page records in redis to hashes.
+
+    This only needs to be run once after upgrading, it is safe to run it
+    again.
+
+    :return: Number of converted pages.
+    '''
+    count = 0
+    for key in redis.scan_iter('page:*'):
+        if redis.type(key) != 'string':
+            continue
+        data = redis.get(key)
+        if not data:
+            continue
+        rpage = json.loads(data)
+        rpage.setdefault('path', key[5:].decode('utf-8'))
+        pipe = redis.pipeline()
+        store_page(pipe, rpage)
+        pipe.execute()
+        count += 1
+    redis.publish(_config('PAGE_CACHE_CHANNEL', 'ukhra:invalidate'), '*')
+    return count
+
+
+def _batches(iterable, size):
+    '''Yields lists of up to size items from the iterable.'''
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _after(columns, values):
+    '''Returns the criterion of the rows coming after the given values,
+    in the order of the columns.'''
+    column, value = columns[0], values[0]
+    if len(columns) == 1:
+        return column > value
+    return sqlalchemy.or_(column > value, sqlalchemy.and_(
+        column == value, _after(columns[1:], values[1:])))
+
+
+def _keyset_batches(query, order, batch_size):
+    '''Yields the rows of the query in lists of up to batch_size rows.
+
+    Every batch is a query of its own starting after the last row of the
+    previous one, so no cursor is left open while the caller runs other
+    queries on the same connection, which MySQLdb and psycopg2 do not
+    support with server side cursors.
+
+    :param query: sqlalchemy Query object, not ordered nor limited.
+    :param order: list of the columns the rows are ordered by, together
+        they must identify a row and be part of the result.
+    :param batch_size: Number of rows per batch.
+    '''
+    last = None
+    while True:
+        batch = query
+        if last is not None:
+            batch = batch.filter(_after(order, last))
+        rows = batch.order_by(*order).limit(batch_size).all()
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        last = [getattr(rows[-1], column.key) for column in order]
+
+
+def get_tags_for_pages(session, page_ids):
+    '''Returns the tags of the given pages with a single query.
+
+    :param session: database connection object
+    :param page_ids: list of page ids
+    :return: dict of page id and list of (tag name, tag id)
+    '''
+    result = dict((page_id, []) for page_id in page_ids)
+    if not page_ids:
+        return result
+    query = session.query(
+        model.PageTags.page_id, model.Tag.name, model.Tag.id
+    ).join(
+        model.Tag, model.Tag.id == model.PageTags.tag_id
+    ).filter(
+        model.PageTags.page_id.in_(page_ids)
+    )
+    for page_id, name, tag_id in query:
+        result[page_id].append((name, tag_id))
+    return result
+
+
+def page_groups(page):
+    '''Returns the names of the groups allowed to edit the page.
+
+    They are stored comma separated in the pagetype column, see
+    update_page_group.
+
+    :param page: model.Page object
+    :return: list of group names, empty if everyone can edit the page.
+    '''
+    if not page.pagetype or page.pagetype == 'published':
+        return []
+    return [name.strip() for name in page.pagetype.split(',') if name.strip()]
+
+
+def page_record(page, tags, html=None):
+    '''Returns the redis page dict for the given model.Page.
+
+    :param page: model.Page object
+    :param tags: list of (tag name, tag id) of the page
+    :param html: compiled HTML of the page, if known
+    :return: page dict
+    '''
+    if not page.format:
+        format = '0'
+    else:
+        format = '1'
+    return {'title': page.title, 'rawtext': page.data, 'html': html,
+            'page_id': page.id, 'version': page.version, 'format': format,
+            'writer': page.writer,
+            'updated': page.updated.strftime(UPDATED_FORMAT),
+            'path': page.path, 'groups': page_groups(page), 'tags': tags}
+
+
+def load_pages(session, pages, pool=None):
+    '''Loads one batch of pages to the redis with a single pipeline.
+
+    :param session: database connection object
+    :param pages: list of model.Page objects
+    :param pool: render.RenderPool used to compile the pages, if None they
+        are compiled in this process.
+    :return: None
+    '''
+    tags = get_tags_for_pages(session, [page.id for page in pages])
+    records = [page_record(page, tags[page.id]) for page in pages]
+    jobs = [(i, page.data, rpage['format'])
+            for i, (page, rpage) in enumerate(zip(pages, records))]
+    for i, html, error in compile_many(jobs, pool):
+        if error:
+            # Keep what we had in the database for the broken page.
+            logger.error('Could not compile page %s: %s',
+                         pages[i].path, error)
+            html = pages[i].html or pages[i].data
+        records[i]['html'] = html
+    # A transaction, store_page deletes the record before writing it again.
+    pipe = redis.pipeline()
+    for page, rpage in zip(pages, records):
+        store_page(pipe, rpage)
+        update_tag_index(pipe, page.path, [], rpage['tags'])
+        add_recent_change(pipe, page.path, page.updated)
+        if _config('SNAPSHOT_DIR', None):
+            pipe.sadd('snapshot:dirty', page.path)
+    pipe.execute()
+    search.index_pages(redis, [search_doc(rpage) for rpage in records])
+
+
+def load_all(session, batch_size=None):
+    '''Loads all pages to the redis.
+
+    The pages are read from the database in batches by id, the tags of each
+    batch are read with one query and written to redis with one pipeline,
+    so the warm-up is bound by the redis bandwidth and not the round trips.
+    The pages are compiled by a pool of RENDER_WORKERS processes.
+
+    :param session: database connection object
+    :param batch_size: Number of pages per batch, defaults to the
+        WARMUP_BATCH_SIZE setting.
+    :return: None
+    '''
+    batch_size = batch_size or _config('WARMUP_BATCH_SIZE', 500)
+    pool = render.RenderPool(_config('RENDER_WORKERS', 0))
+    start = time.time()
+    count = 0
+    try:
+        for pages in _keyset_batches(session.query(model.Page),
+                                     [model.Page.id], batch_size):
+            load_pages(session, pages, pool)
+            for page in pages:
+                session.expunge(page)
+            count += len(pages)
+            elapsed = time.time() - start
+            print "%d pages loaded (%.1f pages/s)" % (
+                count, count / elapsed if elapsed else 0)
+    finally:
+        pool.close()
+    redis.publish(_config('PAGE_CACHE_CHANNEL', 'ukhra:invalidate'), '*')
+    # Replaced by the recentchanges sorted set.
+    redis.delete('latestpages')
     print "All pages loaded in redis."
-    query = session.query(model.User)
-    for user in query:
-        redis.hset('userids', user.id, user.user_name)
-    print "Users loaded."
+
+    query = session.query(
+        model.User.id, model.User.user_name
+    ).execution_options(
+        stream_results=True
+    ).yield_per(batch_size)
+    for users in _batches(query, batch_size):
+        redis.hmset('userids', dict(users))
+    print "Users loaded in %.1f seconds." % (time.time() - start)
+
+
+def add_recent_change(pipe, path, updated):
+    '''Queues the change of a page in the recent changes on a pipeline.
+
+    recentchanges is a sorted set of the paths scored by the time of their
+    last change, so a page shows up once however often it changes. Only
+    the RECENT_CHANGES_LIMIT latest pages are kept.
+
+    :param pipe: Redis pipeline.
+    :param path: Path of the page.
+    :param updated: datetime of the change.
+    :return: None
+    '''
+    score = time.mktime(updated.timetuple()) + updated.microsecond / 1e6
+    pipe.execute_command('ZADD', 'recentchanges', score, path)
+    pipe.zremrangebyrank(
+        'recentchanges', 0, -_config('RECENT_CHANGES_LIMIT', 1000) - 1)
+
+
+def last_change():
+    '''Returns the timestamp of the latest change of any page, or None.'''
+    newest = redis.zrevrange('recentchanges', 0, 0, withscores=True)
+    return newest[0][1] if newest else None
+
+
+def get_recent_changes(before=None, after=None, limit=None):
+    '''Returns the latest changed pages, newest first.
+
+    Many pages can share the same time after a bulk import, so the older
+    changes start after the last page shown and not only after its time.
+
+    :param before: Only return changes made at or before this timestamp.
+    :param after: Path of the last page shown with the before timestamp,
+        this page and the ones before it are skipped.
+    :param limit: Number of pages, defaults to ITEMS_PER_PAGE.
+    :return: tuple of the list of change dicts and the (timestamp, path)
+        to pass as before and after for the older changes (None if there
+        are no more).
+    '''
+    limit = limit or _config('ITEMS_PER_PAGE', 50)
+    skip = 0
+    if before is None:
+        top = '+inf'
+    else:
+        top = repr(before)
+        if after is not None:
+            # Pages with the same time are in reverse order of their path.
+            after = after.encode('utf-8')
+            skip = sum(1 for path in redis.zrevrangebyscore(
+                'recentchanges', top, top) if path >= after)
+    entries = redis.zrevrangebyscore(
+        'recentchanges', top, '-inf', start=skip, num=limit + 1,
+        withscores=True)
+    older = None
+    if len(entries) > limit:
+        path, score = entries[limit - 1]
+        older = (score, path.decode('utf-8'))
+    entries = entries[:limit]
+
+    fields = ('title', 'writer', 'why', 'version')
+    pipe = redis.pipeline(transaction=False)
+    for path, _ in entries:
+        pipe.hmget('page:%s' % path, fields)
+    # Old string records (see convert_page_records) fail with WRONGTYPE,
+    # they are left out like deleted pages.
+    records = [dict((name, decode_page_field(name, value))
+                    for name, value in zip(fields, values))
+               if not isinstance(values, Exception) else {'title': None}
+               for values in pipe.execute(raise_on_error=False)]
+    writers = list(set(record['writer'] for record in records
+                       if record.get('writer') is not None))
+    names = dict(zip(writers, redis.hmget('userids', writers))) \
+        if writers else {}
+
+    result = []
+    for (path, score), record in zip(entries, records):
+        if record['title'] is None:
+            continue
+        record['writer'] = names.get(record['writer'])
+        record['path'] = path.decode('utf-8')
+        record['timestamp'] = score
+        record['updated'] = datetime.utcfromtimestamp(score)
+        result.append(record)
+    return result, older
+
+
+def update_tag_index(pipe, path, old_tags, new_tags):
+    '''Queues the changes of the tag index for one page on a pipeline.
+
+    Every tag has a sorted set tag:<name> of the paths of its pages. All
+    scores are 0, so the paths are kept in lexical order.
+
+    :param pipe: Redis pipeline.
+    :param path: Path of the page.
+    :param old_tags: list of (tag name, tag id) the page had.
+    :param new_tags: list of (tag name, tag id) the page has now.
+    :return: None
+    '''
+    old_names = set(tag[0] for tag in old_tags or [])
+    new_names = set(tag[0] for tag in new_tags or [])
+    for name in old_names - new_names:
+        pipe.zrem(u'tag:%s' % name, path)
+    for name in new_names - old_names:
+        pipe.execute_command('ZADD', u'tag:%s' % name, 0, path)
+
+
+def get_tagged_pages(names, page=1):
+    '''Returns one page of the pages having all the given tags.
+
+    With more than one tag the intersection is stored for TAG_RESULT_TTL
+    seconds, so that the next pages are read from it.
+
+    :param names: list of tag names
+    :param page: Number of the page of results, starting at 1.
+    :return: tuple of the total number of pages and a list of dicts with
+        the path and title of each page, in path order.
+    '''
+    limit = _config('ITEMS_PER_PAGE', 50)
+    names = sorted(set(names))
+    if not names:
+        return 0, []
+    if len(names) == 1:
+        key = u'tag:%s' % names[0]
+    else:
+        key = 'tagresult:%s' % hashlib.sha1(
+            u'\0'.join(names).encode('utf-8')).hexdigest()
+        if not redis.exists(key):
+            pipe = redis.pipeline()
+            pipe.zinterstore(key, [u'tag:%s' % name for name in names])
+            pipe.expire(key, _config('TAG_RESULT_TTL', 30))
+            pipe.execute()
+    start = (page - 1) * limit
+    pipe = redis.pipeline(transaction=False)
+    pipe.zcard(key)
+    pipe.zrange(key, start, start + limit - 1)
+    total, paths = pipe.execute()
+    pipe = redis.pipeline(transaction=False)
+    for path in paths:
+        pipe.hget('page:%s' % path, 'title')
+    result = []
+    for path, title in zip(paths, pipe.execute()):
+        path = path.decode('utf-8')
+        result.append({'path': path,
+                       'title': title.decode('utf-8') if title else path})
+    return total, result
+
+
+def rebuild_tag_index(session, batch_size=None):
+    '''Rebuilds the tag index from the database.
+
+    The new sets are built under other names and renamed at the end, so
+    the tag pages keep working while this runs.
+
+    :param session: database connection object
+    :param batch_size: Number of links written per pipeline, defaults to
+        the WARMUP_BATCH_SIZE setting.
+    :return: Number of tags.
+    '''
+    batch_size = batch_size or _config('WARMUP_BATCH_SIZE', 500)
+    query = session.query(
+        model.Tag.name, model.Page.path
+    ).join(
+        model.PageTags, model.PageTags.tag_id == model.Tag.id
+    ).join(
+        model.Page, model.Page.id == model.PageTags.page_id
+    ).execution_options(
+        stream_results=True
+    ).yield_per(batch_size)
+    names = set()
+    for links in _batches(query, batch_size):
+        pipe = redis.pipeline(transaction=False)
+        for name, path in links:
+            if name not in names:
+                # Left over from a rebuild which did not finish.
+                pipe.delete(u'tagbuild:%s' % name)
+                names.add(name)
+            pipe.execute_command('ZADD', u'tagbuild:%s' % name, 0, path)
+        pipe.execute()
+
+    pipe = redis.pipeline(transaction=False)
+    for name in names:
+        pipe.rename(u'tagbuild:%s' % name, u'tag:%s' % name)
+    for key in redis.scan_iter('tag:*'):
+        if key.decode('utf-8')[4:] not in names:
+            pipe.delete(key)
+    pipe.execute()
+    return len(names)
+
+
+def search_doc(rpage):
+    '''Returns the search index document of a redis page dict.'''
+    return (rpage['path'], rpage['title'], rpage['rawtext'],
+            [tag[0] for tag in rpage.get('tags') or []])
+
+
+def reindex_all(session, batch_size=None):
+    '''Rebuilds the search index of every page from the database.
+
+    :param session: database connection object
+    :param batch_size: Number of pages per batch, defaults to the
+        WARMUP_BATCH_SIZE setting.
+    :return: Number of indexed pages.
+    '''
+    batch_size = batch_size or _config('WARMUP_BATCH_SIZE', 500)
+    start = time.time()
+    count = 0
+    query = session.query(
+        model.Page.id, model.Page.path, model.Page.title, model.Page.data)
+    for pages in _keyset_batches(query, [model.Page.id], batch_size):
+        tags = get_tags_for_pages(session, [page.id for page in pages])
+        search.index_pages(redis, [
+            (page.path, page.title, page.data,
+             [tag[0] for tag in tags[page.id]]) for page in pages])
+        count += len(pages)
+        elapsed = time.time() - start
+        print "%d pages indexed (%.1f pages/s)" % (
+            count, count / elapsed if elapsed else 0)
+    return count
+
+
+def search_pages(query, page=1):
+    '''Returns one page of search results.
+
+    :param query: Text typed by the user.
+    :param page: Number of the page of results, starting at 1.
+    :return: tuple of the total number of results and a list of dicts with
+        the path, title, score and an HTML snippet of each page.
+    '''
+    limit = _config('ITEMS_PER_PAGE', 50)
+    total, results, terms = search.search(
+        redis, query, (page - 1) * limit, limit,
+        _config('SEARCH_RESULT_TTL', 30))
+    pipe = redis.pipeline(transaction=False)
+    for path, score in results:
+        pipe.hmget('page:%s' % path, ('title', 'rawtext'))
+    hits = []
+    for (path, score), (title, rawtext) in zip(results, pipe.execute()):
+        if title is None:
+            continue
+        hits.append({'path': path, 'title': title.decode('utf-8'),
+                     'score': score, 'snippet': search.snippet(
+                         (rawtext or '').decode('utf-8'), terms)})
+    return total, hits
+
+
+# Extensions given to the markdown compiler, they are part of the render
+# cache key.
+MARKDOWN_EXTENSIONS = []
+
+
+def renderer_id(format):
+    '''Returns the name and version of the renderer used for the format.
+
+    :param format: '0' for markdown or '1' for rst.
+    :return: string identifying the renderer and its settings.
+    '''
+    if format == '0':
+        version = getattr(markdown, '__version__', None) or \
+            getattr(markdown, 'version', '')
+        return 'markdown-%s-%s' % (version, ','.join(MARKDOWN_EXTENSIONS))
+    try:
+        version = pkg_resources.get_distribution('nikola').version
+    except pkg_resources.DistributionNotFound:
+        version = ''
+    plugins = hashlib.sha1(fakenikola.plugin_key()).hexdigest()[:12]
+    return 'rst-nikola-%s-%s' % (version, plugins)
+
+
+def render_key(text, format='0'):
+    '''Returns the key of the compiled text in the render cache.
+
+    The key is a hash of the source and of the renderer, so a new renderer
+    version or the RENDER_CACHE_VERSION setting invalidates every entry.
+
+    :param text: Text to be compiled.
+    :param format: '0' for markdown or '1' for rst.
+    :return: hex digest
+    '''
+    text = text or u''
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    digest = hashlib.sha1('%s\0%s\0' % (
+        renderer_id(format), _config('RENDER_CACHE_VERSION', 1)))
+    digest.update(text)
+    return digest.hexdigest()
+
+
+def get_rst_compiler():
+    '''Returns the reST compiler, it is built on the first reST page.
+
+    :return: fakenikola.RSTCompiler object
+    '''
+    return fakenikola.get_compiler(_config('RST_PLUGIN_INDEX'))
+
+
+def warm_rst_compiler():
+    '''Builds the reST compiler and loads docutils right away.
+
+    Preforking servers should call this before forking, so that every
+    worker shares the compiler instead of building its own.
+
+    :return: None
+    '''
+    get_rst_compiler().rst(u'Ukhra\n=====\n\nWarm up.')
 
 
-def compile_text(text, format='0'):
+def compile_text(text, format='0', memo=True):
     '''Compiles the given text to HTML
 
     :param text: Text to be compiled.
     :param format: '0' for markdown or '1' for rst.
+    :param memo: If True, look up the result in the render cache first and
+        store it there afterwards.
     :return: string containing the compiled HTML
     '''
+    if memo:
+        key = render_key(text, format)
+        html = redis.hget('htmlcache', key)
+        if html is not None:
+            return html.decode('utf-8')
+    out, failed = _compile(text, format)
+    # A failure might be a passing error, so it is not cached.
+    if memo and not failed:
+        redis.hset('htmlcache', key, out.encode('utf-8'))
+    return out
+
+
+def _compile(text, format):
+    '''Compiles the text without the render cache.
+
+    :return: tuple of the HTML and a boolean telling if the reST compiler
+        failed, the HTML is then the source itself.
+    '''
     if format == '0':
-        return markdown.markdown(text)
-    else:
-        out, error = COMPILER.rst(text)
-        if not out:
-            out = text
-        return out
+        return markdown.markdown(text), False
+    out, error = get_rst_compiler().rst(text)
+    if not out:
+        return text, True
+    return out, False
+
+
+def compile_many(jobs, pool=None):
+    '''Compiles many texts, using the render cache and a process pool.
+
+    The cached results are read with a single HMGET, only the misses are
+    sent to the pool and the new results are stored with one pipeline.
+
+    :param jobs: list of (key, text, format) tuples.
+    :param pool: render.RenderPool, if None the texts are compiled in this
+        process.
+    :return: list of (key, html, error) tuples, in no particular order.
+    '''
+    if not jobs:
+        return []
+    hashes = [render_key(text, format) for _, text, format in jobs]
+    cached = redis.hmget('htmlcache', hashes)
+    result = []
+    misses = {}
+    for job, digest, html in zip(jobs, hashes, cached):
+        if html is not None:
+            result.append((job[0], html.decode('utf-8'), None))
+        else:
+            misses[job[0]] = digest
+    if not misses:
+        return result
+    if pool is None:
+        pool = render.RenderPool(1)
+    pending = [job for job in jobs if job[0] in misses]
+    pipe = redis.pipeline(transaction=False)
+    for key, html, error in pool.render(pending, ordered=False):
+        if not error:
+            pipe.hset('htmlcache', misses[key], html.encode('utf-8'))
+        result.append((key, html, error))
+    pipe.execute()
+    return result
+
+
+def prune_render_cache(session, batch_size=None):
+    '''Removes the render cache entries no page refers to any more.
+
+    :param session: database connection object
+    :param batch_size: Number of rows read from the database at once.
+    :return: Number of removed entries.
+    '''
+    batch_size = batch_size or _config('WARMUP_BATCH_SIZE', 500)
+    query = session.query(
+        model.Page.data, model.Page.format
+    ).execution_options(
+        stream_results=True
+    ).yield_per(batch_size)
+    used = set(render_key(data, '1' if format else '0')
+               for data, format in query)
+    removed = 0
+    unused = (key for key in redis.hscan_iter('htmlcache')
+              if key[0] not in used)
+    for batch in _batches(unused, batch_size):
+        redis.hdel('htmlcache', *[key for key, _ in batch])
+        removed += len(batch)
+    return removed
+
+
+def parse_tagline(tagline):
+    '''Returns the tag names wanted by a comma separated tag line.
+
+    Names starting with # mark tags to remove, they are left out like any
+    other tag missing from the line.
+
+    :param tagline: comma separated tag names
+    :return: list of unique tag names, in the order of the line.
+    '''
+    names = []
+    for tagname in (tagline or u'').split(','):
+        tagname = tagname.strip()
+        if tagname and not tagname.startswith('#') and tagname not in names:
+            names.append(tagname)
+    return names
+
+
+def ensure_tags(session, names):
+    '''Returns the ids of the named tags, creating the missing ones.
+
+    The missing tags are inserted in bulk in a savepoint of the session, so
+    they are committed along with the rest of the change. A tag created at
+    the same time by another request is not an error, only that savepoint
+    is rolled back and the tags are inserted one at a time.
+
+    :param session: database connection object
+    :param names: list of tag names
+    :return: dict of tag name and tag id
+    '''
+    if not names:
+        return {}
+    found = dict(session.query(
+        model.Tag.name, model.Tag.id
+    ).filter(
+        model.Tag.name.in_(names)
+    ))
+    missing = [name for name in names if name not in found]
+    if missing:
+        insert = model.Tag.__table__.insert()
+        session.begin_nested()
+        try:
+            session.execute(insert, [{'name': name} for name in missing])
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            for name in missing:
+                session.begin_nested()
+                try:
+                    session.execute(insert, {'name': name})
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()
+        # A locking read sees the tags committed by the others since the
+        # transaction started, a plain one only its snapshot.
+        found.update(session.query(
+            model.Tag.name, model.Tag.id
+        ).filter(
+            model.Tag.name.in_(missing)
+        ).with_lockmode('read'))
+    return found
+
+
+def sync_page_tags(session, page_id, tagline):
+    '''Makes the tags of the page match the tag line.
+
+    The current tags are read with one query, the links are added and
+    removed in bulk. Nothing is committed.
+
+    :param session: database connection object
+    :param page_id: id of the page
+    :param tagline: comma separated tag names, see parse_tagline.
+    :return: tuple of the list of (tag name, tag id) of the page and a
+        boolean telling if the tags changed.
+    '''
+    names = parse_tagline(tagline)
+    current = dict(session.query(
+        model.Tag.name, model.Tag.id
+    ).join(
+        model.PageTags, model.PageTags.tag_id == model.Tag.id
+    ).filter(
+        model.PageTags.page_id == page_id
+    ))
+    ids = ensure_tags(session, [name for name in names if name not in current])
+    ids.update(current)
+    added = [ids[name] for name in names if name not in current]
+    removed = [tag_id for name, tag_id in current.items() if name not in names]
+    if added:
+        session.execute(model.PageTags.__table__.insert(), [
+            {'page_id': page_id, 'tag_id': tag_id} for tag_id in added])
+    if removed:
+        table = model.PageTags.__table__
+        session.execute(table.delete().where(sqlalchemy.and_(
+            table.c.page_id == page_id, table.c.tag_id.in_(removed))))
+    return [(name, ids[name]) for name in names], bool(added or removed)
 
 
 def save_page(session, form, path, user_id):
@@ -223,54 +1336,76 @@ def save_page(session, form, path, user_id):
     if form.title:
         page.title = form.title.data
     page.format = form.format.data
+    pending = False
     if form.rawtext:
         page.data = form.rawtext.data
-        html = compile_text(form.rawtext.data, page.format)
-        page.html = html
+        if _config('ASYNC_RENDER', False):
+            pending = True
+        else:
+            html = compile_text(form.rawtext.data, page.format)
+            page.html = html
 
     now = datetime.now()
     page.created = now
     page.updated = now
     page.writer = user_id
     try:
+        names = parse_tagline(form.tags.data)
+        ids = ensure_tags(session, names)
         session.add(page)
+        session.flush()
+        if names:
+            session.execute(model.PageTags.__table__.insert(), [
+                {'page_id': page.id, 'tag_id': ids[name]} for name in names])
+        tags = [(name, ids[name]) for name in names]
+        queued = queue_page_change(
+            session, page, user_id, form.why.data, tags, pending)
         session.commit()
     except Exception, err:
         session.rollback()
+        logger.error(err)
         return False
 
-    tags = []
-    tagline = form.tags.data.strip()
-    if tagline:
-        for tagname in tagline.split(','):
-            tagname = tagname.strip()
-            t = session.query(model.Tag).filter(model.Tag.name == tagname).first()
-            if not t: # If the tag is not in db then first save it.
-                t = model.Tag(name=tagname)
-                session.add(t)
-                session.commit()
-            # Now add the relation.
-            pt = model.PageTags(page_id=page.id, tag_id=t.id)
-            session.add(pt)
-            session.commit()
-            tags.append((t.name, t.id))
-
     # We have it in database
     # now let us fill in the redis.
-    update_page_redis(page, path, user_id, form.why.data, tags)
+    if not queued:
+        update_page_redis(page, path, user_id, form.why.data, tags, pending)
+        if pending:
+            enqueue_render(page)
     return True
 
-def update_page_redis(page, path, user_id, why, tags):
+def update_page_redis(page, path, user_id, why, tags, pending=False,
+                      notify=True):
     '''Updates the page in redis.
 
     :param page: model.Page object
+    :param pending: True if the page is still waiting for the render worker,
+        the HTML of the previous version stays in redis until then.
+    :param notify: if False, do not queue the wikiupdate notification.
     :return: None
     '''
-    rpage = {'title': page.title, 'rawtext':page.data, 'html': page.html, 'page_id': page.id, 'format': unicode(page.format),
-            'writer': user_id, 'updated' : page.updated.strftime('%Y-%m-%d %H:%M'), 'path': path, 'groups': [],
-            'why': why, 'tags': tags}
-    redis.set('page:%s' % path, json.dumps(rpage))
-    mail_update(rpage)
+    old, _ = fetch_page(path, ('tags', 'html'))
+    html = page.html
+    if pending and not html:
+        # The HTML of the new version is cleared until the worker is done,
+        # readers keep seeing the previous one meanwhile.
+        html = old.get('html') if old else None
+        if not html:
+            html = u'<pre>%s</pre>' % cgi.escape(page.data or u'', True)
+    rpage = {'title': page.title, 'rawtext':page.data, 'html': html, 'page_id': page.id, 'format': unicode(page.format),
+            'version': page.version,
+            'writer': user_id, 'updated' : page.updated.strftime(UPDATED_FORMAT), 'path': path, 'groups': page_groups(page),
+            'why': why, 'tags': tags, 'render_pending': pending}
+    pipe = redis.pipeline()
+    store_page(pipe, rpage)
+    update_tag_index(pipe, path, (old or {}).get('tags') or [], tags)
+    add_recent_change(pipe, path, page.updated)
+    pipe.execute()
+    search.index_pages(redis, [search_doc(rpage)])
+    invalidate_page(path)
+    if notify:
+        mail_update(rpage)
+    return rpage
 
 
 def update_page(session, form, path, user_id):
@@ -287,68 +1422,69 @@ def update_page(session, form, path, user_id):
     html = u''
     now = datetime.now()
 
-    rpage = find_page(path)
     # First let us update the page.
-    page = session.query(model.Page).filter(model.Page.id==form.page_id.data).first()
+    # Locked until the commit, the new revision is a delta against the
+    # current text so two saves of the page must not overlap.
+    page = session.query(model.Page).filter(
+        model.Page.id==form.page_id.data
+    ).with_lockmode('update').populate_existing().first()
     if not page:
+        session.rollback()
         return False
 
-    tags = []
-    tag_nochange = True # To mark that tags changed.
-    for tagname in form.tags.data.split(','):
-        tagname = tagname.strip()
-        if tagname.startswith('#'): #If tagname starts with # then remove it.
-            tag_nochange = False
-            t = session.query(model.Tag).filter(model.Tag.name == tagname[1:]).first()
-            pt = session.query(model.PageTags).filter(model.PageTags.page_id==page.id, model.PageTags.tag_id==t.id).first()
-            session.delete(pt)
-            session.commit()
-            continue
-
-        t = session.query(model.Tag).filter(model.Tag.name == tagname).first()
-        if not t: # If the tag is not in db then first save it.
-            t = model.Tag(name=tagname)
-            session.add(t)
-            session.commit()
-        # Now add the relation if missing.
-        pt = session.query(model.PageTags).filter(model.PageTags.page_id==page.id, model.PageTags.tag_id==t.id).first()
-        if not pt:
-            pt = model.PageTags(page_id=page.id, tag_id=t.id)
-            session.add(pt)
-            session.commit()
-        tags.append((t.name, t.id))
-
+    # The tags, the page and its revision are committed together.
+    try:
+        tags, tags_changed = sync_page_tags(session, page.id, form.tags.data)
+    except Exception, err:
+        session.rollback()
+        logger.error(err)
+        return False
 
-    if page.title == form.title.data and page.data == form.rawtext.data and page.format == form.format.data and tag_nochange: # No chance in the page.
+    if page.title == form.title.data and page.data == form.rawtext.data and unicode(page.format) == unicode(form.format.data) and not tags_changed: # No chance in the page.
+        session.rollback()
         return True
+    # Only tags or the title changed, no need to compile again.
+    recompile = page.data != form.rawtext.data or \
+        unicode(page.format) != unicode(form.format.data) or not page.html
+    previous = page.data
     page.title = form.title.data
     page.data = form.rawtext.data
     page.updated = now
     page.version = page.version + 1
     page.format = form.format.data
-    html = compile_text(form.rawtext.data, page.format)
-    page.html = html
-    try:
-        session.commit()
-    except Exception, err:
-        session.rollback()
-        logger.error(err)
-        return False
-    update_page_redis(page, path, user_id, form.why.data, tags)
-    rev = model.Revision(page_id=form.page_id.data)
+    pending = False
+    rev = model.Revision(page_id=page.id)
     rev.title = form.title.data
-    rev.rawtext = form.rawtext.data
     rev.why = form.why.data
     rev.writer = user_id
     rev.created = now
     rev.revision_number = page.version
+    # Revision 1 is always a keyframe as version 0 has no revision row.
+    rev.keyframe = revisions.is_keyframe(
+        page.version, _config('REVISION_KEYFRAME_INTERVAL', 20))
+    rev.delta = revisions.encode(previous, form.rawtext.data, rev.keyframe)
     try:
+        if recompile and _config('ASYNC_RENDER', False):
+            # Readers keep seeing the old HTML until the worker is done.
+            # The stored HTML is cleared so that any later save compiles
+            # the page again, even if only the title or tags changed.
+            pending = True
+            page.html = None
+        elif recompile:
+            html = compile_text(form.rawtext.data, page.format)
+            page.html = html
         session.add(rev)
+        queued = queue_page_change(
+            session, page, user_id, form.why.data, tags, pending)
         session.commit()
     except Exception, err:
         session.rollback()
         logger.error(err)
         return False
+    if not queued:
+        update_page_redis(page, path, user_id, form.why.data, tags, pending)
+        if pending:
+            enqueue_render(page)
 
     return True
 
@@ -380,6 +1516,218 @@ def download_file(file_id):
     return redis.hget('uploads', file_id)
 
 
+def enqueue_render(page):
+    '''Queues the page for the render worker.
+
+    :param page: model.Page object, already committed.
+    :return: None
+    '''
+    q = Queue('wikirender')
+    q.connect()
+    q.enqueue(Task({'page_id': page.id, 'version': page.version}))
+
+
+def render_queued_page(session, data):
+    '''Compiles the page of a render task and publishes the HTML.
+
+    Tasks for a version which is not the current one any more are
+    skipped, the task of the newer version will take care of the page.
+
+    :param session: database connection object
+    :param data: dict with the page_id and version of the page.
+    :return: Boolean, False if the task was skipped.
+    '''
+    # The transaction is always ended, the worker keeps its session open
+    # and would otherwise read an old snapshot of the pages.
+    try:
+        page = session.query(model.Page).filter(
+            model.Page.id == data['page_id']).first()
+        if not page or page.version != data['version']:
+            return False
+        path, version = page.path, page.version
+        format = '1' if unicode(page.format) == u'1' else '0'
+        html = compile_text(page.data, format)
+        session.query(model.Page).filter(
+            model.Page.id == page.id, model.Page.version == version
+        ).update({'html': html}, synchronize_session=False)
+        session.commit()
+    finally:
+        session.rollback()
+
+    key = 'page:%s' % path
+    with redis.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            current = pipe.hget(key, 'version')
+            if current is None or json.loads(current) != version:
+                return False
+            pipe.multi()
+            pipe.hmset(key, encode_page({'html': html,
+                                         'render_pending': False}))
+            pipe.execute()
+        except WatchError:
+            # The page was saved again meanwhile.
+            return False
+    invalidate_page(path)
+    return True
+
+
+def render_worker(session):
+    '''Compiles the pages queued by enqueue_render, forever.
+
+    :param session: database connection object
+    :return: None
+    '''
+    q = Queue('wikirender')
+    q.connect()
+    while True:
+        task = q.wait()
+        try:
+            render_queued_page(session, task.data)
+        except Exception, err:
+            session.rollback()
+            logger.error('Could not render %s: %s', task.data, err)
+
+
+def queue_page_change(session, page, user_id, why, tags, pending):
+    '''Records the side effects of a page change in the outbox.
+
+    The rows are part of the current transaction, so they are committed
+    along with the page. dispatch_outbox then updates redis and sends the
+    notifications. Nothing is recorded unless OUTBOX_ENABLED is set.
+
+    :param session: database connection object
+    :param page: model.Page object, flushed.
+    :param user_id: ID of the user who changed the page.
+    :param why: Summary of the change.
+    :param tags: list of (tag name, tag id) of the page.
+    :param pending: True if the page waits for the render worker.
+    :return: Boolean, True if the change was recorded.
+    '''
+    if not _config('OUTBOX_ENABLED', False):
+        return False
+    # The notification of a superseded version is built from this copy,
+    # the page itself will have moved on by then.
+    session.add(model.Outbox(kind='page', payload=json.dumps({
+        'page_id': page.id, 'version': page.version, 'user_id': user_id,
+        'why': why, 'tags': tags, 'pending': pending, 'title': page.title,
+        'rawtext': page.data,
+        'format': '1' if unicode(page.format) == u'1' else '0',
+        'updated': page.updated.strftime(UPDATED_FORMAT)})))
+    if pending:
+        session.add(model.Outbox(kind='render', payload=json.dumps({
+            'page_id': page.id, 'version': page.version})))
+    return True
+
+
+def _dispatch(entry, data, page):
+    '''Runs the side effect of one outbox entry.
+
+    Running an entry twice has the same effect as running it once.
+
+    :param entry: model.Outbox object
+    :param data: decoded payload of the entry
+    :param page: current model.Page object of the entry or None.
+    :return: None
+    '''
+    if page is None:
+        return
+    if entry.kind == 'render':
+        q = Queue('wikirender')
+        q.connect()
+        q.enqueue(Task(data))
+        return
+    rpage = None
+    if page.version == data['version']:
+        # Older versions are superseded by the entry of the newer one.
+        rpage = update_page_redis(page, page.path, data['user_id'],
+                                  data['why'], data['tags'], data['pending'],
+                                  notify=False)
+    marker = 'outbox:sent:%s' % entry.id
+    if not redis.set(marker, 1, nx=True, ex=7 * 86400):
+        return
+    try:
+        if rpage is None:
+            rpage = page_record(page, data['tags'], page.html)
+            rpage.update({'writer': data['user_id'], 'why': data['why'],
+                          'version': data['version']})
+            if 'rawtext' in data:
+                rpage.update({'title': data['title'],
+                              'rawtext': data['rawtext'],
+                              'format': data['format'],
+                              'updated': data['updated'],
+                              'html': compile_text(data['rawtext'],
+                                                   data['format'])})
+        mail_update(rpage)
+    except Exception:
+        redis.delete(marker)
+        raise
+
+
+def dispatch_outbox(session, batch_size=None):
+    '''Runs the side effects recorded in the outbox, in order.
+
+    A failed entry is retried on the next run, up to OUTBOX_MAX_ATTEMPTS
+    times. Until then the later entries of the same page wait, so that
+    the changes of a page are applied in order. Only run one dispatcher.
+
+    :param session: database connection object
+    :param batch_size: Number of entries handled at once.
+    :return: Number of entries dispatched.
+    '''
+    batch_size = batch_size or _config('OUTBOX_BATCH_SIZE', 100)
+    entries = session.query(
+        model.Outbox
+    ).filter(
+        model.Outbox.dispatched == None,
+        model.Outbox.attempts < _config('OUTBOX_MAX_ATTEMPTS', 10)
+    ).order_by(
+        model.Outbox.id
+    ).limit(batch_size).all()
+    if not entries:
+        # End the transaction, the next poll has to see the new rows.
+        session.rollback()
+        return 0
+    payloads = dict((entry.id, json.loads(entry.payload)) for entry in entries)
+    page_ids = set(data['page_id'] for data in payloads.values())
+    pages = dict((page.id, page) for page in session.query(
+        model.Page).filter(model.Page.id.in_(page_ids)))
+    failed = set()
+    done = 0
+    now = datetime.now()
+    for entry in entries:
+        data = payloads[entry.id]
+        if data['page_id'] in failed:
+            continue
+        try:
+            _dispatch(entry, data, pages.get(data['page_id']))
+            entry.dispatched = now
+            done += 1
+        except Exception, err:
+            failed.add(data['page_id'])
+            entry.attempts += 1
+            entry.last_error = unicode(err)
+            logger.error('Outbox entry %s failed: %s', entry.id, err)
+    session.commit()
+    return done
+
+
+def outbox_worker(session):
+    '''Dispatches the outbox, forever.
+
+    :param session: database connection object
+    :return: None
+    '''
+    while True:
+        try:
+            if dispatch_outbox(session):
+                continue
+        except Exception, err:
+            session.rollback()
+            logger.error('Outbox dispatch failed: %s', err)
+        time.sleep(_config('OUTBOX_POLL_INTERVAL', 1))
+
+
 def mail_update(rpage):
     'Send a message for each update.'
     q = Queue('wikiupdate')
@@ -397,22 +1745,154 @@ def update_page_group(session, path, groups):
     page = session.query(model.Page).filter(model.Page.path==path).first()
     if not page:
         print 'Sorry no such page.'
-    page.pagetype == groups
+        return
+    page.pagetype = groups
     session.commit()
-    gnames = [name.strip() for name in groups.split(',')]
-    rpage = json.loads(redis.get('page:%s' % path))
-    rpage['groups'] = gnames
-    redis.set('page:%s' % path, json.dumps(rpage))
+    redis.hset('page:%s' % path, 'groups', json.dumps(page_groups(page)))
+    invalidate_page(path)
+
 
+def get_page_revisions(session, path, before=None, after=None, limit=None):
+    '''Returns one page of the history of a page, newest first.
 
-def get_page_revisions(session, path):
-    page = find_page(path)
-    revs = session.query(model.Revision).filter(model.Revision.page_id==page['page_id']).order_by(model.Revision.revision_number.desc())
+    The history is paged on the revision number instead of an offset, so
+    every page costs the same however deep the user goes. Only the small
+    columns are loaded, and the writers are resolved in one redis call.
+
+    :param session: database connection object
+    :param path: Path of the page
+    :param before: Return the revisions older than this number.
+    :param after: Return the revisions newer than this number.
+    :param limit: Number of revisions, defaults to ITEMS_PER_PAGE.
+    :return: tuple of the list of revisions, the number to pass as after
+        for the newer ones and the number to pass as before for the older
+        ones (None if there are no more).
+    '''
+    limit = limit or _config('ITEMS_PER_PAGE', 50)
+    page = find_page(path, ('page_id',))
+    if not page:
+        return [], None, None
+    rev = model.Revision
+    query = session.query(
+        rev.id, rev.revision_number, rev.title, rev.created, rev.why,
+        rev.writer
+    ).filter(rev.page_id == page['page_id'])
+    if after is not None:
+        rows = query.filter(rev.revision_number > after).order_by(
+            rev.revision_number).limit(limit + 1).all()
+        more_newer = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        more_older = True
+        # The revision before the oldest one is the cursor itself.
+        previous = [row.revision_number for row in rows[1:]] + [after]
+    else:
+        if before is not None:
+            query = query.filter(rev.revision_number < before)
+        rows = query.order_by(
+            rev.revision_number.desc()).limit(limit + 1).all()
+        more_older = len(rows) > limit
+        more_newer = before is not None
+        previous = [row.revision_number for row in rows[1:]] + [None]
+        rows = rows[:limit]
+    if not rows:
+        return [], None, None
+
+    writers = list(set(row.writer for row in rows))
+    names = dict(zip(writers, redis.hmget('userids', writers)))
     result = []
-    for rev in revs:
-        user = redis.hget('userids', rev.writer)
-        data = {'revision': rev.revision_number, 'title': rev.title, 'id': rev.id, 'created': rev.created,
-                'writer': user, 'why': rev.why}
-        result.append(data)
+    for row, previous_number in zip(rows, previous):
+        result.append({'revision': row.revision_number, 'title': row.title,
+                       'id': row.id, 'created': row.created,
+                       'writer': names[row.writer], 'why': row.why,
+                       'previous': previous_number})
+    newer = result[0]['revision'] if more_newer else None
+    older = result[-1]['revision'] if more_older else None
+    return result, newer, older
+
+
+def get_revision(session, path, revision_number):
+    '''Returns the given revision of a page along with its source.
+
+    :param session: database connection object
+    :param path: Path of the page
+    :param revision_number: Number of the revision
+    :return: dict or None if there is no such revision.
+    '''
+    page = find_page(path, ('page_id', 'format'))
+    if not page:
+        return None
+    rev = session.query(
+        model.Revision.id, model.Revision.title, model.Revision.why,
+        model.Revision.writer, model.Revision.created
+    ).filter(
+        model.Revision.page_id == page['page_id'],
+        model.Revision.revision_number == revision_number
+    ).first()
+    if not rev:
+        return None
+    rawtext = revisions.get_revision_text(
+        session, page['page_id'], revision_number)
+    return {'revision': revision_number, 'id': rev.id, 'title': rev.title,
+            'why': rev.why, 'created': rev.created,
+            'writer': redis.hget('userids', rev.writer),
+            'rawtext': rawtext, 'format': page['format'],
+            'html': compile_text(rawtext or u'', page['format'])}
+
+
+def get_revision_diff(session, path, old, new):
+    '''Returns the differences between two revisions of a page.
+
+    Diffs are cached in redis by the pair of revision ids, as the history
+    page keeps asking for the same ones.
+
+    :param session: database connection object
+    :param path: Path of the page
+    :param old: Number of the old revision
+    :param new: Number of the new revision
+    :return: dict with the two revisions and the hunks of lib.diff, None if
+        one of the revisions does not exist.
+    '''
+    page = find_page(path, ('page_id',))
+    if not page:
+        return None
+    rows = dict((row.revision_number, row) for row in session.query(
+        model.Revision.id, model.Revision.revision_number,
+        model.Revision.title, model.Revision.created
+    ).filter(
+        model.Revision.page_id == page['page_id'],
+        model.Revision.revision_number.in_([old, new])
+    ))
+    if old not in rows or new not in rows:
+        return None
+    result = {}
+    for name, number in (('old', old), ('new', new)):
+        row = rows[number]
+        result[name] = {'revision': number, 'id': row.id,
+                        'title': row.title, 'created': row.created}
+
+    key = 'diff:%s:%s' % (rows[old].id, rows[new].id)
+    cached = redis.get(key)
+    if cached:
+        result['hunks'] = json.loads(cached)
+        return result
+    hunks = diff.diff_texts(
+        revisions.get_revision_text(session, page['page_id'], old),
+        revisions.get_revision_text(session, page['page_id'], new),
+        _config('DIFF_MAX_EDITS', 1000))
+    # Revisions never change, the TTL only bounds the memory used.
+    redis.set(key, json.dumps(hunks, separators=(',', ':')),
+              ex=_config('DIFF_CACHE_TTL', 86400))
+    result['hunks'] = hunks
     return result
 
+
+def convert_revisions(session):
+    '''Moves old revisions from Revision.rawtext to the delta storage.
+
+    :param session: database connection object
+    :return: Number of converted revisions.
+    '''
+    return revisions.migrate_revisions(
+        session, _config('REVISION_KEYFRAME_INTERVAL', 20))
+
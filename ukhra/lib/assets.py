@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014  Kushal Das <kushaldas@gmail.com>
+# Copyright © 2014  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+Ukhra static asset fingerprinting.
+
+build() copies every file of the static folder to dist/, with a hash of
+its content in the name (css/bootstrap.min.css becomes
+dist/css/bootstrap.min.3f2a9c1d5e7b.css), writes a .gz variant of the
+text files next to it, and records the names in dist/manifest.json. The
+url() references between the files are rewritten to the new names, so
+the CSS changes its hash when a font it uses changes.
+
+A fingerprinted file never changes, so it can be cached forever.
+'''
+
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+# Formats which are not compressed already.
+COMPRESSIBLE = ('.css', '.js', '.map', '.svg', '.eot', '.ttf', '.html',
+                '.txt')
+
+URL_RE = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def _hashed_name(name, data):
+    '''Returns the name with the hash of the data before the extension.'''
+    base, ext = posixpath.splitext(name)
+    return '%s.%s%s' % (base, hashlib.sha1(data).hexdigest()[:12], ext)
+
+
+def _write(filename, data):
+    '''Writes the file under a temporary name and renames it into place.'''
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as fobj:
+        fobj.write(data)
+    os.rename(tmpname, filename)
+
+
+def _write_gzip(filename, data):
+    '''Writes the .gz variant of the file.'''
+    tmpname = filename + '.gz.tmp'
+    # mtime=0 so that a rebuild gives the same bytes.
+    fobj = gzip.GzipFile(tmpname, 'wb', 9, mtime=0)
+    try:
+        fobj.write(data)
+    finally:
+        fobj.close()
+    os.rename(tmpname, filename + '.gz')
+
+
+def rewrite_urls(name, data, manifest):
+    '''Points the url() references of a CSS file to the fingerprinted
+    files.
+
+    :param name: Name of the CSS file, relative to the static folder.
+    :param data: Content of the CSS file.
+    :param manifest: dict of the original and fingerprinted names.
+    :return: new content
+    '''
+    folder = posixpath.dirname(name)
+
+    def replace(match):
+        quote, url = match.groups()
+        if url.startswith(('data:', 'http:', 'https:', '//', '/')):
+            return match.group(0)
+        # Keep the ?#iefix and #fragment suffixes of the font URLs.
+        path, suffix = re.match(r'([^?#]*)(.*)', url).groups()
+        target = posixpath.normpath(posixpath.join(folder, path))
+        if target not in manifest:
+            return match.group(0)
+        new = posixpath.relpath(manifest[target], posixpath.join(DIST,
+                                                                 folder))
+        return 'url(%s%s%s%s)' % (quote, new, suffix, quote)
+
+    return URL_RE.sub(replace, data)
+
+
+def build(static_folder):
+    '''Fingerprints every file of the static folder into dist/.
+
+    :param static_folder: Static folder of the theme.
+    :return: dict of the original and fingerprinted names, relative to
+        the static folder.
+    '''
+    names = []
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        if dirpath == static_folder and DIST in dirnames:
+            dirnames.remove(DIST)
+        for filename in filenames:
+            names.append(os.path.relpath(
+                os.path.join(dirpath, filename),
+                static_folder).replace(os.sep, '/'))
+    # The CSS files refer to the others, so they need their names first.
+    names.sort(key=lambda name: (name.endswith('.css'), name))
+
+    manifest = {}
+    for name in names:
+        with open(os.path.join(static_folder, name), 'rb') as fobj:
+            data = fobj.read()
+        if name.endswith('.css'):
+            data = rewrite_urls(name, data, manifest)
+        hashed = posixpath.join(DIST, _hashed_name(name, data))
+        filename = os.path.join(static_folder, hashed)
+        if not os.path.exists(filename):
+            _write(filename, data)
+            if name.endswith(COMPRESSIBLE):
+                _write_gzip(filename, data)
+        manifest[name] = hashed
+
+    # Older files are kept, pages cached by browsers may still use them.
+    _write(os.path.join(static_folder, DIST, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True))
+    return manifest
+
+
+def load_manifest(static_folder):
+    '''Returns the manifest written by build(), empty if there is none.'''
+    try:
+        with open(os.path.join(static_folder, DIST, MANIFEST)) as fobj:
+            return json.load(fobj)
+    except (IOError, ValueError):
+        return {}
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014  Kushal Das <kushaldas@gmail.com>
+# Copyright © 2014  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+Ukhra in-process page cache.
+
+Each worker process keeps the most recently used pages, and the groups of
+the users, in memory so that they do not need a redis round trip on every
+view. Entries are dropped when any process publishes an invalidation on
+the redis channel.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+import logging
+logger = logging.getLogger(__name__)
+
+
+class PageCache(object):
+    '''A thread safe LRU cache bounded by number of entries and bytes.'''
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        # Bumped on every invalidation, see put()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        '''Returns the cached value for the key or None.'''
+        with self.lock:
+            try:
+                value, size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Mark as most recently used.
+            self.entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size, generation):
+        '''Stores the value in the cache.
+
+        :param key: Key of the entry.
+        :param value: Value to be stored.
+        :param size: Size of the value in bytes.
+        :param generation: Value of self.generation taken before the value
+            was read from redis. If an invalidation came in after that, the
+            value might be stale and is not stored.
+        '''
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, oldsize) = self.entries.popitem(last=False)
+                self.size -= oldsize
+                self.evictions += 1
+
+    def invalidate(self, key):
+        '''Removes the given key from the cache.'''
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= old[1]
+
+    def clear(self):
+        '''Removes every entry from the cache.'''
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        '''Returns a dict of the cache counters.'''
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'entries': len(self.entries), 'bytes': self.size,
+                    'max_entries': self.max_entries,
+                    'max_bytes': self.max_bytes}
+
+
+def listen(redis, channel, caches):
+    '''Subscribes to the invalidation channel and keeps the caches in sync.
+
+    Messages are either '*' to clear every cache, or '<name>:<key>' to drop
+    the key from the cache of that name.
+
+    This runs forever, so call it from a daemon thread. If the connection
+    to redis is lost we may have missed messages, so the caches are
+    cleared before subscribing again.
+
+    :param redis: Redis connection object.
+    :param channel: Name of the channel to listen on.
+    :param caches: dict of name and PageCache object.
+    '''
+    while True:
+        try:
+            pubsub = redis.pubsub()
+            pubsub.subscribe(channel)
+            for cache in caches.values():
+                cache.clear()
+            for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                # Pages are cached by their unicode path.
+                data = message['data'].decode('utf-8')
+                if data == '*':
+                    for cache in caches.values():
+                        cache.clear()
+                    continue
+                name, _, key = data.partition(':')
+                if name == 'usergroups':
+                    key = int(key)
+                if name in caches:
+                    caches[name].invalidate(key)
+        except Exception, err:
+            logger.error('Cache listener failed: %s', err)
+            for cache in caches.values():
+                cache.clear()
+            time.sleep(1)
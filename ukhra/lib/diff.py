@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014  Kushal Das <kushaldas@gmail.com>
+# Copyright © 2014  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+Ukhra revision diffs.
+
+Lines are compared with the Myers algorithm, which takes O((N+M)D) time
+for D changed lines, after trimming the common head and tail. Revisions
+are usually small edits of each other, so this stays close to linear in
+the size of the page. Past max_edits changes we fall back to difflib.
+
+A diff is a list of hunks, which is also its JSON form:
+
+    ["e", count, [first lines], [last lines]]  unchanged lines
+    ["d", [lines]]                              removed lines
+    ["i", [lines]]                              added lines
+    ["r", [old lines], [new lines], words]      changed lines
+
+words is a list of ["e" | "d" | "i", text] for the changed words.
+'''
+
+import cgi
+import difflib
+import re
+
+# Unchanged lines kept around each change.
+CONTEXT = 3
+
+WORD_RE = re.compile(r'\s+|\w+|[^\w\s]', re.UNICODE)
+
+
+def _myers(a, b, max_edits):
+    '''Returns the opcodes turning a into b, or None if there are more than
+    max_edits changes.
+
+    :param a: list of hashable items.
+    :param b: list of hashable items.
+    :param max_edits: Highest number of inserted and deleted items.
+    :return: list of (tag, i1, i2, j1, j2) like difflib's get_opcodes.
+    '''
+    n, m = len(a), len(b)
+    limit = min(n + m, max_edits)
+    offset = limit + 1
+    v = [0] * (2 * limit + 3)
+    trace = []
+    for d in range(limit + 1):
+        # v as it was before this step, for k in -d-1 .. d+1.
+        trace.append(v[offset - d - 1:offset + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    return None
+
+
+def _backtrack(trace, n, m):
+    '''Walks the Myers trace back into opcodes.'''
+    moves = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1 + d + 1] < v[k + 1 + d + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k + d + 1]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            moves.append(('equal', x, y))
+        if d > 0:
+            if x == prev_x:
+                moves.append(('insert', x, prev_y))
+            else:
+                moves.append(('delete', prev_x, y))
+        x, y = prev_x, prev_y
+    moves.reverse()
+
+    opcodes = []
+    for tag, x, y in moves:
+        i2 = x + (tag != 'insert')
+        j2 = y + (tag != 'delete')
+        if opcodes and opcodes[-1][0] == tag:
+            opcodes[-1][2] = i2
+            opcodes[-1][4] = j2
+        else:
+            opcodes.append([tag, x, i2, y, j2])
+    return _merge_replaces(opcodes)
+
+
+def _merge_replaces(opcodes):
+    '''Joins the deletes and inserts next to each other into replaces.'''
+    result = []
+    for op in opcodes:
+        if result and op[0] in ('delete', 'insert') and \
+                result[-1][0] in ('delete', 'insert', 'replace') and \
+                result[-1][0] != op[0]:
+            last = result[-1]
+            result[-1] = ['replace', last[1], op[2], last[3], op[4]]
+        else:
+            result.append(list(op))
+    return [tuple(op) for op in result]
+
+
+def opcodes(a, b, max_edits=1000):
+    '''Returns the opcodes turning the list a into the list b.
+
+    :param a: list of hashable items.
+    :param b: list of hashable items.
+    :param max_edits: Changes after which difflib is used instead.
+    :return: list of (tag, i1, i2, j1, j2) like difflib's get_opcodes.
+    '''
+    n, m = len(a), len(b)
+    head = 0
+    while head < n and head < m and a[head] == b[head]:
+        head += 1
+    tail = 0
+    while tail < n - head and tail < m - head and \
+            a[n - 1 - tail] == b[m - 1 - tail]:
+        tail += 1
+
+    # Compare small integers instead of the lines themselves.
+    ids = {}
+    middle_a = [ids.setdefault(item, len(ids)) for item in a[head:n - tail]]
+    middle_b = [ids.setdefault(item, len(ids)) for item in b[head:m - tail]]
+    middle = _myers(middle_a, middle_b, max_edits)
+    if middle is None:
+        matcher = difflib.SequenceMatcher(None, middle_a, middle_b,
+                                          autojunk=False)
+        middle = matcher.get_opcodes()
+
+    result = []
+    if head:
+        result.append(('equal', 0, head, 0, head))
+    for tag, i1, i2, j1, j2 in middle:
+        result.append((tag, i1 + head, i2 + head, j1 + head, j2 + head))
+    if tail:
+        result.append(('equal', n - tail, n, m - tail, m))
+    return result
+
+
+def diff_words(old, new, max_edits=1000):
+    '''Returns the word level changes between two pieces of text.
+
+    :param old: unicode text
+    :param new: unicode text
+    :return: list of ["e" | "d" | "i", text]
+    '''
+    a = WORD_RE.findall(old)
+    b = WORD_RE.findall(new)
+    words = []
+    for tag, i1, i2, j1, j2 in opcodes(a, b, max_edits):
+        if tag == 'equal':
+            words.append(['e', u''.join(a[i1:i2])])
+            continue
+        if i2 > i1:
+            words.append(['d', u''.join(a[i1:i2])])
+        if j2 > j1:
+            words.append(['i', u''.join(b[j1:j2])])
+    return words
+
+
+def diff_texts(old, new, max_edits=1000):
+    '''Returns the hunks turning one source into the other.
+
+    :param old: unicode source
+    :param new: unicode source
+    :param max_edits: Changes after which difflib is used instead.
+    :return: list of hunks, see the module documentation.
+    '''
+    a = (old or u'').splitlines()
+    b = (new or u'').splitlines()
+    hunks = []
+    for tag, i1, i2, j1, j2 in opcodes(a, b, max_edits):
+        if tag == 'equal':
+            lines = a[i1:i2]
+            if len(lines) <= 2 * CONTEXT:
+                hunks.append(['e', len(lines), lines, []])
+            else:
+                hunks.append(['e', len(lines), lines[:CONTEXT],
+                              lines[-CONTEXT:]])
+        elif tag == 'delete':
+            hunks.append(['d', a[i1:i2]])
+        elif tag == 'insert':
+            hunks.append(['i', b[j1:j2]])
+        else:
+            hunks.append(['r', a[i1:i2], b[j1:j2], diff_words(
+                u'\n'.join(a[i1:i2]), u'\n'.join(b[j1:j2]), max_edits)])
+    return hunks
+
+
+def _row(css, text):
+    return u'<tr class="%s"><td><pre>%s</pre></td></tr>' % (css, text)
+
+
+def to_html(hunks):
+    '''Returns the hunks as the rows of an HTML table.
+
+    :param hunks: list of hunks as returned by diff_texts.
+    :return: unicode HTML
+    '''
+    rows = []
+    for index, hunk in enumerate(hunks):
+        tag = hunk[0]
+        if tag == 'e':
+            count, first, last = hunk[1:]
+            # No context is needed before the first or after the last change.
+            leading = first[:CONTEXT] if index > 0 else []
+            trailing = (last or first)[-CONTEXT:] \
+                if index < len(hunks) - 1 else []
+            if leading and trailing and not last:
+                leading, trailing = first, []
+            for line in leading:
+                rows.append(_row('diff-equal', cgi.escape(line)))
+            if len(leading) + len(trailing) < count:
+                rows.append(_row('diff-skip text-muted', u'\u2026'))
+            for line in trailing:
+                rows.append(_row('diff-equal', cgi.escape(line)))
+        elif tag == 'd':
+            for line in hunk[1]:
+                rows.append(_row('diff-delete bg-danger', cgi.escape(line)))
+        elif tag == 'i':
+            for line in hunk[1]:
+                rows.append(_row('diff-insert bg-success', cgi.escape(line)))
+        else:
+            old = []
+            new = []
+            for wtag, text in hunk[3]:
+                text = cgi.escape(text)
+                if wtag == 'e':
+                    old.append(text)
+                    new.append(text)
+                elif wtag == 'd':
+                    old.append(u'<del>%s</del>' % text)
+                else:
+                    new.append(u'<ins>%s</ins>' % text)
+            rows.append(_row('diff-delete bg-danger', u''.join(old)))
+            rows.append(_row('diff-insert bg-success', u''.join(new)))
+    return u'\n'.join(rows)
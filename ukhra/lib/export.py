@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014  Kushal Das <kushaldas@gmail.com>
+# Copyright © 2014  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+Ukhra wiki export.
+
+The wiki is written as JSON lines, one object per row with a "type" key:
+export (the header), user, group, membership, tag, page, pagetag and
+revision.
+Rows are read in keyset batches as plain tuples, never as mapped objects,
+so the memory used does not grow with the wiki and no cursor stays open
+while the revisions need other queries.
+Revisions are written with their full source, rebuilt from the deltas
+while streaming them in order. The users are exported with their password
+hashes, so keep the files private.
+'''
+
+import datetime
+import json
+
+import ukhra.lib as mmlib
+from ukhra.lib import model
+from ukhra.lib import revisions
+
+FORMAT_VERSION = 1
+
+USER_COLUMNS = ('id', 'user_name', 'email_address', 'display_name',
+                'password', 'created', 'updated_on')
+GROUP_COLUMNS = ('id', 'group_name', 'display_name', 'created')
+MEMBERSHIP_COLUMNS = ('user_id', 'group_id')
+TAG_COLUMNS = ('id', 'name')
+PAGE_COLUMNS = ('id', 'path', 'title', 'format', 'data', 'created',
+                'updated', 'pagetype', 'version', 'writer')
+REVISION_COLUMNS = ('id', 'page_id', 'revision_number', 'title', 'created',
+                    'why', 'writer', 'rawtext', 'delta', 'keyframe')
+
+
+def _default(value):
+    '''Encodes the dates for json.dumps.'''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def _stream(session, table, names, batch_size, criteria=(), order=None):
+    '''Yields the rows of a model as dicts of the given columns, ordered by
+    its primary key unless another order is given. The order must identify
+    a row.'''
+    columns = [getattr(table, name) for name in names]
+    if order is None:
+        order = [column for column in columns if column.primary_key]
+    query = session.query(*columns).filter(*criteria)
+    for rows in mmlib._keyset_batches(query, order, batch_size):
+        for row in rows:
+            yield dict(zip(names, row))
+
+
+def _page_tags(session, since, batch_size):
+    '''Yields the (page id, tag id) links of the exported pages.'''
+    query = session.query(
+        model.PageTags.page_id, model.PageTags.tag_id)
+    if since is not None:
+        query = query.join(
+            model.Page, model.Page.id == model.PageTags.page_id
+        ).filter(model.Page.updated >= since)
+    order = [model.PageTags.page_id, model.PageTags.tag_id]
+    for rows in mmlib._keyset_batches(query, order, batch_size):
+        for page_id, tag_id in rows:
+            yield {'page_id': page_id, 'tag_id': tag_id}
+
+
+def _revisions(session, since, batch_size):
+    '''Yields the revisions with their full source.'''
+    criteria = []
+    if since is not None:
+        criteria.append(model.Revision.created >= since)
+    last = None
+    text = None
+    # Ordered by page and number, so the unique index can be used.
+    order = (model.Revision.page_id, model.Revision.revision_number)
+    for row in _stream(session, model.Revision, REVISION_COLUMNS,
+                       batch_size, criteria, order):
+        rawtext, delta, keyframe = [row.pop(name) for name in
+                                    ('rawtext', 'delta', 'keyframe')]
+        follows = last == (row['page_id'], row['revision_number'] - 1)
+        if delta is None:
+            text = rawtext
+        elif keyframe or follows:
+            text = revisions.decode(text, delta, keyframe)
+        else:
+            # The revision before it was not exported, see since.
+            text = revisions.get_revision_text(
+                session, row['page_id'], row['revision_number'])
+        last = (row['page_id'], row['revision_number'])
+        row['text'] = text
+        yield row
+
+
+def export_wiki(session, out, since=None, batch_size=500, progress=None):
+    '''Writes the wiki to a file object as JSON lines.
+
+    Pages are ordered by id and revisions by page and number, so that
+    the rows an import needs first come first.
+
+    :param session: database connection object
+    :param out: file object, opened for writing
+    :param since: datetime, only export the users, pages and revisions
+        changed since then. Groups and tags are always exported in full.
+    :param batch_size: Number of rows fetched from the database at once.
+    :param progress: Called with the type and the counts after every
+        batch_size rows.
+    :return: dict of the number of rows of each type.
+    '''
+    counts = {}
+
+    def write(kind, rows):
+        for row in rows:
+            row['type'] = kind
+            out.write(json.dumps(row, default=_default,
+                                 separators=(',', ':')))
+            out.write('\n')
+            counts[kind] = counts.get(kind, 0) + 1
+            if progress and counts[kind] % batch_size == 0:
+                progress(kind, counts)
+
+    write('export', [{'version': FORMAT_VERSION,
+                      'created': datetime.datetime.utcnow(),
+                      'since': since}])
+    user_criteria = [] if since is None else \
+        [model.User.updated_on >= since]
+    write('user', _stream(session, model.User, USER_COLUMNS, batch_size,
+                          user_criteria))
+    write('group', _stream(session, model.Group, GROUP_COLUMNS, batch_size))
+    write('membership', _stream(session, model.UserGroup,
+                                MEMBERSHIP_COLUMNS, batch_size))
+    write('tag', _stream(session, model.Tag, TAG_COLUMNS, batch_size))
+    page_criteria = [] if since is None else \
+        [model.Page.updated >= since]
+    write('page', _stream(session, model.Page, PAGE_COLUMNS, batch_size,
+                          page_criteria))
+    write('pagetag', _page_tags(session, since, batch_size))
+    write('revision', _revisions(session, since, batch_size))
+    if progress:
+        progress(None, counts)
+    return counts
@@ -3,40 +3,122 @@ from copy import copy
 from pkg_resources import resource_filename
 import datetime
 import glob
+import json
 import locale
 import os
 import sys
 import mimetypes
+import threading
 try:
     from urlparse import urlparse, urlsplit, urljoin
 except ImportError:
     from urllib.parse import urlparse, urlsplit, urljoin # NOQA
 
-from yapsy.PluginManager import PluginManager
 import logging
 logging.basicConfig(level=logging.INFO)
-from nikola.plugins.compile.rest import rst2html
-
-
-from nikola import utils
-from nikola.plugin_categories import (
-    Command,
-    LateTask,
-    PageCompiler,
-    RestExtension,
-    MarkdownExtension,
-    Task,
-    TaskMultiplier,
-    TemplateSystem,
-    SignalHandler,
-)
+
+# Nikola and its plugins are only imported when the first reST page gets
+# compiled, see get_compiler().
 
 logger = logging.getLogger(__name__)
 
+COMPILER = None
+_COMPILER_LOCK = threading.Lock()
+PLUGIN_KEY = None
+
+
+def _plugin_places():
+    '''Returns the directories yapsy looks for plugins in.'''
+    from nikola import utils
+    extra_plugins_dirs = ''
+    return [
+            resource_filename('nikola', utils.sys_encode('plugins')),
+            os.path.join(os.getcwd(), utils.sys_encode('plugins')),
+            os.path.expanduser('~/.nikola/plugins'),
+        ] + [utils.sys_encode(path) for path in extra_plugins_dirs if path]
+
+
+def _plugin_index_key(places):
+    '''Returns the key the plugin index is valid for.
+
+    It changes with the Nikola version and whenever a plugin directory is
+    modified.
+    '''
+    import nikola
+    mtimes = []
+    for place in places:
+        try:
+            mtimes.append(os.stat(place).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return json.dumps([getattr(nikola, '__version__', ''), places, mtimes])
+
+
+def plugin_key():
+    '''Returns the key of the installed Nikola version and reST extensions.
+
+    It is the key of the plugin index, computed once per process, so the
+    render cache can tell apart the HTML of different plugin sets.
+
+    :return: string, empty if Nikola is not installed.
+    '''
+    global PLUGIN_KEY
+    if PLUGIN_KEY is None:
+        try:
+            PLUGIN_KEY = _plugin_index_key(_plugin_places())
+        except ImportError:
+            PLUGIN_KEY = ''
+    return PLUGIN_KEY
+
+
+def _read_plugin_index(path, key):
+    '''Returns the cached list of RestExtension info files or None.'''
+    if not path:
+        return None
+    try:
+        with open(path) as fobj:
+            index = json.load(fobj)
+    except (IOError, ValueError):
+        return None
+    if index.get('key') != key:
+        return None
+    return index.get('plugins')
+
+
+def _write_plugin_index(path, key, plugins):
+    '''Stores the list of RestExtension info files, atomically.'''
+    if not path:
+        return
+    tmp = '%s.%s' % (path, os.getpid())
+    try:
+        with open(tmp, 'w') as fobj:
+            json.dump({'key': key, 'plugins': plugins}, fobj)
+        os.rename(tmp, path)
+    except (IOError, OSError), err:
+        logger.warning('Could not write the plugin index %s: %s', path, err)
 
 
 class FakeNikola(object):
-    def __init__(self):
+    '''Just enough of the Nikola site object for the reST extensions.
+
+    :param plugin_index: Path of the file caching which plugins are reST
+        extensions. When it is valid only those plugins are loaded, instead
+        of scanning and importing every plugin on disk.
+    '''
+
+    def __init__(self, plugin_index=None):
+        from yapsy.PluginManager import PluginManager
+        from nikola.plugin_categories import (
+            Command,
+            LateTask,
+            PageCompiler,
+            RestExtension,
+            MarkdownExtension,
+            Task,
+            TaskMultiplier,
+            TemplateSystem,
+            SignalHandler,
+        )
 
         self.config = {'DISABLED_PLUGINS': []}
         self.debug = False
@@ -54,15 +136,14 @@ class FakeNikola(object):
             "SignalHandler": SignalHandler,
         })
         self.plugin_manager.setPluginInfoExtension('plugin')
-        extra_plugins_dirs = ''
-        places = [
-                resource_filename('nikola', utils.sys_encode('plugins')),
-                os.path.join(os.getcwd(), utils.sys_encode('plugins')),
-                os.path.expanduser('~/.nikola/plugins'),
-            ] + [utils.sys_encode(path) for path in extra_plugins_dirs if path]
-
+        places = _plugin_places()
         self.plugin_manager.setPluginPlaces(places)
-        self.plugin_manager.collectPlugins()
+
+        key = _plugin_index_key(places)
+        plugins = _read_plugin_index(plugin_index, key)
+        if plugins is None or not self._load_indexed(plugins):
+            plugins = self._scan()
+            _write_plugin_index(plugin_index, key, plugins)
 
         #self.pug = None
         #for plugin_info in self.plugin_manager.getPluginsOfCategory("PageCompiler"):
@@ -77,17 +158,51 @@ class FakeNikola(object):
             plugin_info.plugin_object.set_site(self)
             plugin_info.plugin_object.short_help = plugin_info.description
 
+    def _scan(self):
+        '''Loads every plugin found on disk.
+
+        :return: list of the info files of the RestExtension plugins.
+        '''
+        self.plugin_manager.locatePlugins()
+        infofiles = dict((plugin_info.path, infofile) for infofile, _, plugin_info
+                         in self.plugin_manager.getPluginCandidates())
+        self.plugin_manager.loadPlugins()
+        return [infofiles[plugin_info.path] for plugin_info
+                in self.plugin_manager.getPluginsOfCategory("RestExtension")
+                if plugin_info.path in infofiles]
+
+    def _load_indexed(self, plugins):
+        '''Loads only the given plugins.
+
+        :param plugins: list of plugin info files.
+        :return: False if one of them could not be read.
+        '''
+        locator = self.plugin_manager.getPluginLocator()
+        try:
+            for infofile in plugins:
+                plugin_info, _ = locator.gatherCorePluginInfo(
+                    os.path.dirname(infofile), os.path.basename(infofile))
+                if plugin_info is None:
+                    return False
+                self.plugin_manager.appendPluginCandidate(
+                    (infofile, plugin_info.path, plugin_info))
+        except Exception, err:
+            logger.warning('Invalid plugin index, scanning again: %s', err)
+            return False
+        self.plugin_manager.loadPlugins()
+        return True
 
 
 class RSTCompiler(object):
 
-    def __init__(self):
-        self.f = FakeNikola()
+    def __init__(self, plugin_index=None):
+        self.f = FakeNikola(plugin_index)
         self.spath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'template.txt')
         if not os.path.exists(self.spath):
             self.spath = '/usr/lib/python2.6/site-packages/nikola/plugins/compile/rest/template.txt'
 
     def rst(self, source):
+        from nikola.plugins.compile.rest import rst2html
         output, error_level, deps = rst2html(
                         source, settings_overrides={
                             'initial_header_level': 1,
@@ -99,3 +214,20 @@ class RSTCompiler(object):
                             'template': self.spath,
                         }, l_source=source, logger=logger)
         return output, error_level
+
+
+def get_compiler(plugin_index=None):
+    '''Returns the RSTCompiler of this process, building it on first use.
+
+    A process which builds it before forking its workers shares it with
+    all of them.
+
+    :param plugin_index: Path of the plugin index file, see FakeNikola.
+    :return: RSTCompiler object
+    '''
+    global COMPILER
+    if COMPILER is None:
+        with _COMPILER_LOCK:
+            if COMPILER is None:
+                COMPILER = RSTCompiler(plugin_index)
+    return COMPILER
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014  Kushal Das <kushaldas@gmail.com>
+# Copyright © 2014  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+Ukhra bulk import.
+
+Pages are read from a directory of Markdown and reST files or from a
+MediaWiki XML dump as dicts with the path, title, text, format, tags and
+updated keys. They are then written in batches: one bulk insert for the
+pages, one for their first revision and one for their tags, and one
+commit per batch, after which the batch is loaded in redis. Paths already
+in the database are skipped, so an interrupted import can simply be run
+again.
+'''
+
+import codecs
+import os
+import re
+import time
+from datetime import datetime
+from xml.etree import cElementTree
+
+import sqlalchemy
+
+import ukhra.lib as mmlib
+from ukhra.lib import model
+from ukhra.lib import render
+from ukhra.lib import revisions
+
+import logging
+logger = logging.getLogger(__name__)
+
+# model.Page.format values.
+MARKDOWN = 0
+RST = 1
+
+EXTENSIONS = {'.md': MARKDOWN, '.markdown': MARKDOWN, '.rst': RST}
+
+RST_META_RE = re.compile(r'^\.\. (\w+): ?(.*)$')
+MEDIAWIKI_CATEGORY_RE = re.compile(r'\[\[Category:([^\]|]+)', re.IGNORECASE)
+
+
+def _split_list(value):
+    '''Returns the names of "a, b" or "[a, b]".'''
+    value = value.strip().strip('[]')
+    return [name.strip().strip('\'"') for name in value.split(',')
+            if name.strip().strip('\'"')]
+
+
+def parse_front_matter(text, format):
+    '''Returns the metadata at the top of a file and the rest of it.
+
+    Markdown files may start with a block of "key: value" lines between
+    two "---" lines, reST files with Nikola style ".. key: value" lines.
+
+    :param text: unicode content of the file
+    :param format: MARKDOWN or RST
+    :return: tuple of a dict of metadata and the text without it.
+    '''
+    meta = {}
+    lines = text.splitlines(True)
+    if format == MARKDOWN:
+        if not lines or lines[0].strip() != '---':
+            return meta, text
+        for index, line in enumerate(lines[1:], 1):
+            if line.strip() == '---':
+                return meta, u''.join(lines[index + 1:]).lstrip('\n')
+            key, sep, value = line.partition(':')
+            if sep:
+                meta[key.strip().lower()] = value.strip()
+        # No closing line, this was not front matter.
+        return {}, text
+    index = 0
+    for index, line in enumerate(lines):
+        match = RST_META_RE.match(line.rstrip('\n'))
+        if not match:
+            break
+        meta[match.group(1).lower()] = match.group(2).strip()
+    else:
+        index = len(lines)
+    if not meta:
+        return meta, text
+    return meta, u''.join(lines[index:]).lstrip('\n')
+
+
+def _title_from_text(text, format):
+    '''Returns the first heading of the text, or None.'''
+    lines = text.splitlines()
+    for index, line in enumerate(lines[:20]):
+        if format == MARKDOWN and line.startswith('#'):
+            return line.strip('#').strip()
+        if format == RST and index + 1 < len(lines) and line.strip() and \
+                re.match(r'^([=\-~`#*^"+])\1+\s*$', lines[index + 1]):
+            return line.strip()
+    return None
+
+
+def read_directory(root):
+    '''Yields the pages of a directory tree of .md and .rst files.
+
+    The path of a page is the path of its file without the extension, an
+    index file gives its directory path.
+
+    :param root: Directory to read.
+    :return: iterator of page dicts.
+    '''
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            name, ext = os.path.splitext(filename)
+            format = EXTENSIONS.get(ext.lower())
+            if format is None:
+                continue
+            filepath = os.path.join(dirpath, filename)
+            relative = os.path.relpath(os.path.join(dirpath, name), root)
+            parts = relative.split(os.sep)
+            if parts[-1].lower() == 'index' and len(parts) > 1:
+                parts.pop()
+            path = u'/'.join(parts).lower()
+            if not isinstance(path, unicode):
+                path = path.decode('utf-8')
+            with codecs.open(filepath, encoding='utf-8') as fobj:
+                meta, text = parse_front_matter(fobj.read(), format)
+            title = meta.get('title') or _title_from_text(text, format) or \
+                parts[-1].replace('-', ' ').replace('_', ' ')
+            yield {'path': path, 'title': title, 'text': text,
+                   'format': format,
+                   'tags': _split_list(meta.get('tags', u'')),
+                   'updated': datetime.fromtimestamp(
+                       os.path.getmtime(filepath))}
+
+
+def _local(tag):
+    '''Returns the tag name without its XML namespace.'''
+    return tag.rsplit('}', 1)[-1]
+
+
+def read_mediawiki(source):
+    '''Yields the pages of a MediaWiki XML dump.
+
+    Only the latest revision of the pages of the main namespace is read,
+    redirects are skipped and categories become tags. The wikitext is
+    kept as it is and rendered as Markdown, so the markup will need
+    cleaning up by hand.
+
+    The dump is parsed incrementally, memory does not grow with its size.
+
+    :param source: File name or file object of the dump.
+    :return: iterator of page dicts.
+    '''
+    context = cElementTree.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event != 'end' or _local(elem.tag) != 'page':
+            continue
+        fields = {}
+        redirect = False
+        for child in elem.iter():
+            name = _local(child.tag)
+            if name in ('title', 'ns', 'text', 'timestamp'):
+                fields[name] = unicode(child.text or u'')
+            elif name == 'redirect':
+                redirect = True
+        # Frees the parsed pages, root would keep them otherwise.
+        elem.clear()
+        root.clear()
+        if redirect or fields.get('ns', u'0') != u'0':
+            continue
+        title = fields.get('title', u'').strip()
+        if not title:
+            continue
+        text = fields.get('text', u'')
+        try:
+            updated = datetime.strptime(fields.get('timestamp', ''),
+                                        '%Y-%m-%dT%H:%M:%SZ')
+        except ValueError:
+            updated = datetime.now()
+        yield {'path': title.replace(u' ', u'_').lower(), 'title': title,
+               'text': text, 'format': MARKDOWN,
+               'tags': [name.strip() for name in
+                        MEDIAWIKI_CATEGORY_RE.findall(text)],
+               'updated': updated}
+
+
+def _missing_in_redis(paths):
+    '''Returns the paths which have no page record in redis.'''
+    paths = list(paths)
+    pipe = mmlib.redis.pipeline(transaction=False)
+    for path in paths:
+        pipe.exists('page:%s' % path)
+    return [path for path, found in zip(paths, pipe.execute()) if not found]
+
+
+def _import_batch(session, docs, user_id, pool):
+    '''Writes one batch of pages.
+
+    :return: tuple of the ids of the new pages and the set of the paths
+        which were already in the database.
+    '''
+    paths = [doc['path'] for doc in docs]
+    existing = set(path for path, in session.query(
+        model.Page.path).filter(model.Page.path.in_(paths)))
+    new = {}
+    for doc in docs:
+        if doc['path'] not in existing and doc['path'] not in new:
+            new[doc['path']] = doc
+    if not new:
+        return [], existing
+    docs = new.values()
+
+    # Committed along with the pages of the batch.
+    names = sorted(set(name for doc in docs for name in doc['tags']))
+    tag_ids = mmlib.ensure_tags(session, names)
+
+    jobs = [(doc['path'], doc['text'], unicode(doc['format']))
+            for doc in docs]
+    html = {}
+    for path, result, error in mmlib.compile_many(jobs, pool):
+        if error:
+            logger.error('Could not compile page %s: %s', path, error)
+        html[path] = result
+
+    session.execute(model.Page.__table__.insert(), [
+        {'path': doc['path'], 'title': doc['title'][:255],
+         'format': doc['format'], 'data': doc['text'],
+         'html': html.get(doc['path']), 'created': doc['updated'],
+         'updated': doc['updated'], 'pagetype': 'published',
+         'version': 0, 'writer': user_id} for doc in docs])
+    ids = dict(session.query(model.Page.path, model.Page.id).filter(
+        model.Page.path.in_(new.keys())))
+
+    # Revision 0 holds the imported source, later edits start at 1.
+    session.execute(model.Revision.__table__.insert(), [
+        {'page_id': ids[doc['path']], 'revision_number': 0,
+         'title': doc['title'][:255], 'created': doc['updated'],
+         'why': u'Imported', 'writer': user_id, 'keyframe': True,
+         'delta': revisions.encode(None, doc['text'], True)}
+        for doc in docs])
+    links = [{'page_id': ids[doc['path']], 'tag_id': tag_ids[name]}
+             for doc in docs for name in set(doc['tags'])]
+    if links:
+        session.execute(model.PageTags.__table__.insert(), links)
+    session.commit()
+    return ids.values(), existing
+
+
+def import_pages(session, docs, user_id, batch_size=500, workers=0):
+    '''Imports the pages into the database and loads them in redis.
+
+    Each batch is loaded in redis right after it is committed. Pages which
+    are already in the database are skipped, but loaded again if they are
+    missing in redis, so an interrupted import can be run again.
+
+    :param session: database connection object
+    :param docs: iterable of page dicts, see read_directory.
+    :param user_id: id of the user the pages are written by.
+    :param batch_size: Number of pages inserted at once.
+    :param workers: Number of render processes, see RENDER_WORKERS.
+    :return: tuple of the number of imported and skipped pages.
+    '''
+    pool = render.RenderPool(workers)
+    start = time.time()
+    imported = []
+    seen = 0
+    try:
+        for batch in mmlib._batches(docs, batch_size):
+            try:
+                ids, existing = _import_batch(session, batch, user_id, pool)
+            except Exception:
+                session.rollback()
+                raise
+            imported.extend(ids)
+            # Left behind by an import which stopped before loading them.
+            missing = _missing_in_redis(existing)
+            if ids or missing:
+                wanted = []
+                if ids:
+                    wanted.append(model.Page.id.in_(ids))
+                if missing:
+                    wanted.append(model.Page.path.in_(missing))
+                pages = session.query(model.Page).filter(
+                    sqlalchemy.or_(*wanted)).all()
+                # The HTML is in the render cache by now.
+                mmlib.load_pages(session, pages, pool)
+                for page in pages:
+                    session.expunge(page)
+                session.rollback()
+            seen += len(batch)
+            elapsed = time.time() - start
+            print "%d pages read, %d imported (%.1f pages/s)" % (
+                seen, len(imported), seen / elapsed if elapsed else 0)
+    finally:
+        pool.close()
+    mmlib.redis.publish(
+        mmlib._config('PAGE_CACHE_CHANNEL', 'ukhra:invalidate'), '*')
+    elapsed = time.time() - start
+    print "Imported %d pages in %.1f seconds (%.1f pages/s)." % (
+        len(imported), elapsed, len(imported) / elapsed if elapsed else 0)
+    return len(imported), seen - len(imported)
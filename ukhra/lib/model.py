@@ -187,17 +187,44 @@ class Revision(BASE):
         sa.Integer, sa.ForeignKey('page.id'), nullable=False)
     revision_number = sa.Column(sa.Integer, nullable=False)
     title = sa.Column(sa.String(255), nullable=False)
-    rawtext = sa.Column(sa.TEXT, nullable=True)
+    rawtext = sa.Column(sa.TEXT, nullable=True) # only on old rows
+    delta = sa.Column(sa.LargeBinary, nullable=True) # see lib.revisions
+    keyframe = sa.Column(sa.Boolean, nullable=True)
     created = sa.Column(sa.DateTime, nullable=False)
     why = sa.Column(sa.String(255), nullable=True)
     writer = sa.Column(
         sa.Integer, sa.ForeignKey('mm_user.id'), nullable=False)
 
+    # For the history of a page, newest first. Unique as the revisions are
+    # stored as deltas against the previous one.
+    __table_args__ = (
+        sa.Index('ix_revision_page_number', 'page_id', 'revision_number',
+                 unique=True),
+    )
+
     def __repr__(self):
         ''' Return a string representation of the object. '''
         return u'<Revision(%s - Page:%s - %s)>' % (self.id, self.page_id, self.revision_number)
 
 
+class Outbox(BASE):
+    'Side effects of a page change, dispatched after the commit.'
+    __tablename__ = 'outbox'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    kind = sa.Column(sa.String(50), nullable=False)
+    payload = sa.Column(sa.TEXT, nullable=False) # JSON
+    created = sa.Column(
+        sa.DateTime, nullable=False, default=datetime.datetime.now)
+    attempts = sa.Column(sa.Integer, nullable=False, default=0)
+    last_error = sa.Column(sa.TEXT, nullable=True)
+    dispatched = sa.Column(sa.DateTime, nullable=True, index=True)
+
+    def __repr__(self):
+        ''' Return a string representation of the object. '''
+        return u'<Outbox(%s - %s)>' % (self.id, self.kind)
+
+
 class Comments(BASE):
     "Comments on bugs."
     __tablename__ = 'comment'
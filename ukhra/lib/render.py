@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014  Kushal Das <kushaldas@gmail.com>
+# Copyright © 2014  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+Ukhra parallel page rendering.
+
+Compiling markdown or reST is pure CPU work, so bulk jobs like load_all
+hand the pages over to a pool of worker processes.
+'''
+
+import itertools
+import multiprocessing
+import logging
+logger = logging.getLogger(__name__)
+
+
+def _render(job):
+    '''Renders one job, errors are returned instead of raised.
+
+    :param job: tuple of key, text and format.
+    :return: tuple of key, HTML and error message (None on success).
+    '''
+    key, text, format = job
+    try:
+        from ukhra.lib import _compile
+        html, failed = _compile(text, format)
+        if failed:
+            # The source is returned as the HTML, but must not be cached.
+            return key, html, 'The reST compiler returned nothing'
+        return key, html, None
+    except Exception, err:
+        return key, None, '%s: %s' % (err.__class__.__name__, err)
+
+
+class RenderPool(object):
+    '''Pool of processes compiling pages.
+
+    :param workers: Number of worker processes, 0 or None means one per
+        CPU. With a single worker the pages are rendered in this process.
+    '''
+
+    def __init__(self, workers=None):
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            self.pool = multiprocessing.Pool(workers)
+
+    def render(self, jobs, ordered=True, chunksize=8):
+        '''Renders the jobs.
+
+        A page which fails to compile does not stop the others, its error
+        is returned in place of the HTML.
+
+        :param jobs: iterable of (key, text, format) tuples.
+        :param ordered: If False, results are returned as soon as they are
+            ready instead of in the order of the jobs.
+        :param chunksize: Number of jobs sent to a worker at once.
+        :return: iterator of (key, html, error) tuples.
+        '''
+        if self.pool is None:
+            return itertools.imap(_render, jobs)
+        if ordered:
+            return self.pool.imap(_render, jobs, chunksize)
+        return self.pool.imap_unordered(_render, jobs, chunksize)
+
+    def close(self):
+        '''Stops the worker processes.'''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014  Kushal Das <kushaldas@gmail.com>
+# Copyright © 2014  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+Ukhra revision storage.
+
+The source of a revision is stored zlib compressed in Revision.delta,
+either in full (a keyframe) or as a line delta against the previous
+revision. A keyframe is written every REVISION_KEYFRAME_INTERVAL
+revisions, so rebuilding a revision never applies more deltas than that.
+Old rows keep their source in Revision.rawtext until migrate_revisions
+converts them.
+'''
+
+import difflib
+import json
+import zlib
+
+import sqlalchemy as sa
+from sqlalchemy.engine import reflection
+from sqlalchemy.exc import IntegrityError
+
+from ukhra.lib import model
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def is_keyframe(revision_number, interval, has_previous=True):
+    '''Returns whether the revision is stored in full.
+
+    :param revision_number: Number of the revision.
+    :param interval: Number of revisions between two keyframes.
+    :param has_previous: False if the previous revision is not stored.
+    :return: Boolean
+    '''
+    return not has_previous or (revision_number - 1) % interval == 0
+
+
+def encode(previous, text, keyframe):
+    '''Returns the value of Revision.delta for the text.
+
+    :param previous: Source of the previous revision, unused for keyframes.
+    :param text: Source of this revision.
+    :param keyframe: If True the text is stored in full.
+    :return: compressed bytes
+    '''
+    text = text or u''
+    if keyframe:
+        return zlib.compress(text.encode('utf-8'))
+    old = (previous or u'').splitlines(True)
+    new = text.splitlines(True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            # Lines copied from the previous revision.
+            ops.append([i1, i2])
+        elif tag in ('replace', 'insert'):
+            ops.append(u''.join(new[j1:j2]))
+    return zlib.compress(json.dumps(ops, separators=(',', ':')))
+
+
+def decode(previous, delta, keyframe):
+    '''Returns the source stored in Revision.delta.
+
+    :param previous: Source of the previous revision, unused for keyframes.
+    :param delta: Value of Revision.delta
+    :param keyframe: Value of Revision.keyframe
+    :return: unicode source
+    '''
+    data = zlib.decompress(delta)
+    if keyframe:
+        return data.decode('utf-8')
+    old = (previous or u'').splitlines(True)
+    result = []
+    for op in json.loads(data):
+        if isinstance(op, list):
+            result.extend(old[op[0]:op[1]])
+        else:
+            result.append(op)
+    return u''.join(result)
+
+
+def rebuild_text(rows):
+    '''Returns the source of the last of the given revisions.
+
+    :param rows: list of (rawtext, delta, keyframe) of consecutive
+        revisions, the first one being a keyframe or an old full row.
+    :return: unicode source
+    '''
+    text = None
+    for rawtext, delta, keyframe in rows:
+        if delta is None:
+            text = rawtext
+        else:
+            text = decode(text, delta, keyframe)
+    return text
+
+
+def get_revision_text(session, page_id, revision_number):
+    '''Returns the source of the given revision of the page.
+
+    :param session: database connection object
+    :param page_id: id of the page
+    :param revision_number: number of the revision
+    :return: unicode source or None if there is no such revision.
+    '''
+    rev = model.Revision
+    start = session.query(
+        sa.func.max(rev.revision_number)
+    ).filter(
+        rev.page_id == page_id,
+        rev.revision_number <= revision_number,
+        sa.or_(rev.keyframe == True, rev.delta == None)
+    ).scalar()
+    if start is None:
+        return None
+    rows = session.query(
+        rev.revision_number, rev.rawtext, rev.delta, rev.keyframe
+    ).filter(
+        rev.page_id == page_id,
+        rev.revision_number >= start,
+        rev.revision_number <= revision_number
+    ).order_by(
+        rev.revision_number
+    ).all()
+    if not rows or rows[-1][0] != revision_number:
+        return None
+    return rebuild_text([row[1:] for row in rows])
+
+
+def _upgrade_table(engine):
+    '''Adds the delta and keyframe columns and the history index to an old
+    revision table.'''
+    inspector = reflection.Inspector.from_engine(engine)
+    existing = set(column['name'] for column in
+                   inspector.get_columns('revision'))
+    for name in ('delta', 'keyframe'):
+        if name in existing:
+            continue
+        column = model.Revision.__table__.c[name]
+        engine.execute('ALTER TABLE revision ADD COLUMN %s %s' % (
+            name, column.type.compile(dialect=engine.dialect)))
+    indexes = dict((index['name'], index) for index in
+                   inspector.get_indexes('revision'))
+    for index in model.Revision.__table__.indexes:
+        old = indexes.get(index.name)
+        if old is not None and bool(old['unique']) == bool(index.unique):
+            continue
+        if old is not None:
+            # The first version of the history index was not unique.
+            index.drop(engine)
+        try:
+            index.create(engine)
+        except IntegrityError:
+            logger.error('Could not create %s, the revision table has '
+                         'duplicate revision numbers.', index.name)
+            raise
+
+
+def migrate_revisions(session, interval):
+    '''Upgrades the revision table and converts the revisions still stored
+    in full in Revision.rawtext.
+
+    It is safe to run it again, or on a partly converted table.
+
+    :param session: database connection object
+    :param interval: Number of revisions between two keyframes.
+    :return: Number of converted revisions.
+    '''
+    _upgrade_table(session.get_bind())
+    rev = model.Revision
+    page_ids = [page_id for page_id, in session.query(
+        rev.page_id).filter(rev.delta == None).distinct()]
+    count = 0
+    for page_id in page_ids:
+        previous = None
+        previous_number = None
+        for row in session.query(rev).filter(
+                rev.page_id == page_id).order_by(rev.revision_number):
+            if row.delta is None:
+                text = row.rawtext
+                keyframe = is_keyframe(
+                    row.revision_number, interval,
+                    previous_number == row.revision_number - 1)
+                row.delta = encode(previous, text, keyframe)
+                row.keyframe = keyframe
+                row.rawtext = None
+                count += 1
+            else:
+                text = decode(previous, row.delta, row.keyframe)
+            previous = text
+            previous_number = row.revision_number
+        session.commit()
+    return count
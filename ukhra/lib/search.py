@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014  Kushal Das <kushaldas@gmail.com>
+# Copyright © 2014  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+Ukhra full text search.
+
+The index lives in redis next to the pages:
+
+    search:term:<term>   sorted set of the paths containing the term,
+                         scored by the weight of the term in the page.
+    search:terms:<path>  set of the terms of a page, to remove them again
+                         when the page changes.
+    search:docs          set of the indexed paths.
+
+A query is the intersection of the sets of its terms, each weighted by
+its inverse document frequency. The result is kept for a few seconds so
+that the next pages of results are cheap.
+'''
+
+import cgi
+import hashlib
+import math
+import re
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+STOPWORDS = frozenset(u'''a an and are as at be by for from has in is it its
+of on or that the this to was were will with'''.split())
+
+# A term in the title counts this many times as much as one in the text.
+TITLE_BOOST = 5
+TAG_BOOST = 3
+
+DOCS_KEY = 'search:docs'
+
+
+def tokenize(text):
+    '''Returns the terms of the text, in order.
+
+    :param text: unicode text
+    :return: list of lower case terms
+    '''
+    return [word for word in WORD_RE.findall((text or u'').lower())
+            if len(word) > 1 and word not in STOPWORDS]
+
+
+def page_terms(title, rawtext, tags):
+    '''Returns the weight of every term of a page.
+
+    :param title: Title of the page
+    :param rawtext: Source of the page
+    :param tags: list of tag names
+    :return: dict of term and score
+    '''
+    counts = {}
+    for term in tokenize(rawtext):
+        counts[term] = counts.get(term, 0) + 1
+    for term in tokenize(title):
+        counts[term] = counts.get(term, 0) + TITLE_BOOST
+    for tag in tags:
+        for term in tokenize(tag):
+            counts[term] = counts.get(term, 0) + TAG_BOOST
+    # Sublinear, a page saying a word 100 times is not 100 times better.
+    return dict((term, 1 + math.log(count))
+                for term, count in counts.iteritems())
+
+
+def _key(term):
+    return u'search:term:%s' % term
+
+
+def index_pages(redis, docs):
+    '''Adds or updates pages in the index with two round trips.
+
+    :param redis: Redis connection object.
+    :param docs: list of (path, title, rawtext, tag names) tuples.
+    :return: None
+    '''
+    if not docs:
+        return
+    pipe = redis.pipeline(transaction=False)
+    for doc in docs:
+        pipe.smembers(u'search:terms:%s' % doc[0])
+    olds = pipe.execute()
+
+    pipe = redis.pipeline(transaction=False)
+    for (path, title, rawtext, tags), old in zip(docs, olds):
+        terms = page_terms(title, rawtext, tags)
+        for term in old:
+            if term.decode('utf-8') not in terms:
+                pipe.zrem(_key(term.decode('utf-8')), path)
+        for term, score in terms.iteritems():
+            pipe.execute_command('ZADD', _key(term), score, path)
+        key = u'search:terms:%s' % path
+        pipe.delete(key)
+        if terms:
+            pipe.sadd(key, *terms.keys())
+        pipe.sadd(DOCS_KEY, path)
+    pipe.execute()
+
+
+def search(redis, query, start=0, count=20, ttl=30):
+    '''Returns the pages matching every term of the query, best first.
+
+    :param redis: Redis connection object.
+    :param query: Text typed by the user.
+    :param start: Index of the first result.
+    :param count: Number of results.
+    :param ttl: Seconds the full result is kept for the next pages.
+    :return: tuple of the total number of results, the list of
+        (path, score) and the terms searched for.
+    '''
+    terms = sorted(set(tokenize(query)))
+    if not terms:
+        return 0, [], terms
+    if len(terms) == 1:
+        key = _key(terms[0])
+    else:
+        key = 'search:result:%s' % hashlib.sha1(
+            u'\0'.join(terms).encode('utf-8')).hexdigest()
+        if not redis.exists(key):
+            pipe = redis.pipeline(transaction=False)
+            pipe.scard(DOCS_KEY)
+            for term in terms:
+                pipe.zcard(_key(term))
+            counts = pipe.execute()
+            total = counts[0]
+            if not all(counts[1:]):
+                return 0, [], terms
+            weights = dict(
+                (_key(term), math.log(1.0 + float(total) / df))
+                for term, df in zip(terms, counts[1:]))
+            pipe = redis.pipeline(transaction=False)
+            pipe.zinterstore(key, weights)
+            pipe.expire(key, ttl)
+            pipe.execute()
+    pipe = redis.pipeline(transaction=False)
+    pipe.zcard(key)
+    pipe.zrevrange(key, start, start + count - 1, withscores=True)
+    total, results = pipe.execute()
+    return total, [(path.decode('utf-8'), score)
+                   for path, score in results], terms
+
+
+def snippet(text, terms, width=200):
+    '''Returns an HTML snippet of the text around the first matching term,
+    with the terms highlighted.
+
+    :param text: Source of the page
+    :param terms: list of terms searched for
+    :param width: Number of characters of the snippet.
+    :return: unicode HTML
+    '''
+    text = text or u''
+    pattern = re.compile(u'\\b(%s)\\b' % u'|'.join(
+        re.escape(term) for term in terms), re.UNICODE | re.IGNORECASE)
+    match = pattern.search(text) if terms else None
+    begin = max(0, match.start() - width // 3) if match else 0
+    part = text[begin:begin + width]
+    html = []
+    last = 0
+    for found in pattern.finditer(part) if terms else []:
+        html.append(cgi.escape(part[last:found.start()]))
+        html.append(u'<mark>%s</mark>' % cgi.escape(found.group(0)))
+        last = found.end()
+    html.append(cgi.escape(part[last:]))
+    prefix = u'…' if begin else u''
+    suffix = u'…' if begin + width < len(text) else u''
+    return prefix + u''.join(html) + suffix
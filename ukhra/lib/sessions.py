@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014  Kushal Das <kushaldas@gmail.com>
+# Copyright © 2014  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+Ukhra redis session objects.
+'''
+
+
+class SessionUser(object):
+    '''The logged in user as stored along with the session in redis.
+
+    It offers the attributes of model.User the application uses, without
+    touching the database. Use ukhra.lib.get_user_groups for the groups.
+    '''
+
+    def __init__(self, visit):
+        self.id = visit['user_id']
+        self.user_name = visit['user_name']
+        self.display_name = visit.get('display_name')
+        self.email_address = visit.get('email_address')
+
+    @property
+    def username(self):
+        ''' Return the username. '''
+        return self.user_name
+
+    def __repr__(self):
+        ''' Return a string representation of this object. '''
+        return 'SessionUser: %s - name %s' % (self.id, self.user_name)
@@ -122,13 +122,17 @@ def do_login():
             visit_key = ukhra.lib.id_generator(40)
             expiry = datetime.datetime.now() + APP.config.get(
                 'PERMANENT_SESSION_LIFETIME')
+            if _redis_sessions():
+                ukhra.lib.store_visit(
+                    visit_key, user_obj, flask.request.remote_addr, expiry)
             session = model.UserVisit(
                 user_id=user_obj.id,
                 user_ip=flask.request.remote_addr,
                 visit_key=visit_key,
                 expiry=expiry,
             )
-            SESSION.add(session)
+            if not _redis_sessions() or _sql_audit():
+                SESSION.add(session)
             try:
                 SESSION.commit()
                 flask.g.fas_user = user_obj
@@ -334,12 +338,49 @@ Your Bugspad2 admin.
 def logout():
     """ Log the user out by expiring the user's session.
     """
+    if _redis_sessions() and flask.g.fas_session_id:
+        ukhra.lib.delete_visit(SESSION, flask.g.fas_session_id)
     flask.g.fas_session_id = None
     flask.g.fas_user = None
 
     flask.flash('You have been logged out', "success")
 
 
+def _redis_sessions():
+    """ Returns whether the sessions are kept in redis. """
+    return APP.config.get('SESSION_BACKEND', 'sql') == 'redis'
+
+
+def _sql_audit():
+    """ Returns whether redis sessions are also recorded in the database.
+    """
+    return APP.config.get('SESSION_SQL_AUDIT', True)
+
+
+def _check_redis_session(sessionid):
+    """ Returns the session id and user of a session kept in redis.
+
+    A logged in request does not touch the database, unless redis lost the
+    session and it has to be restored from the database, or the expiry
+    gets extended while SESSION_SQL_AUDIT is on.
+    """
+    visit = ukhra.lib.get_visit(sessionid)
+    if visit is None and _sql_audit():
+        visit = ukhra.lib.restore_visit(SESSION, sessionid)
+    if visit is None:
+        return None, None
+    if APP.config.get('CHECK_SESSION_IP', True) \
+            and visit['user_ip'] != flask.request.remote_addr:
+        flask.flash('Session expired', 'error')
+        return None, None
+    ukhra.lib.refresh_visit(
+        SESSION, sessionid, visit,
+        APP.config.get('PERMANENT_SESSION_LIFETIME'),
+        APP.config.get('SESSION_REFRESH_FRACTION', 0.25),
+        _sql_audit())
+    return sessionid, ukhra.lib.sessions.SessionUser(visit)
+
+
 def _check_session_cookie():
     """ Set the user into flask.g if the user is logged in.
     """
@@ -347,7 +388,11 @@ def _check_session_cookie():
     session_id = None
     user = None
 
-    if cookie_name and cookie_name in flask.request.cookies:
+    if _redis_sessions():
+        sessionid = flask.request.cookies.get(cookie_name)
+        if sessionid:
+            session_id, user = _check_redis_session(sessionid)
+    elif cookie_name and cookie_name in flask.request.cookies:
         sessionid = flask.request.cookies[cookie_name]
         session = ukhra.lib.get_session_by_visitkey(
             SESSION, sessionid)
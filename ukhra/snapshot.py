@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014  Kushal Das <kushaldas@gmail.com>
+# Copyright © 2014  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+Ukhra static snapshots.
+
+The anonymous view of every page is written to SNAPSHOT_DIR/page/<path>.html
+so that the web server can send it without calling the application, see
+utilities/ukhra.conf. Pages are rendered through the application itself,
+so the files are exactly what an anonymous reader would get.
+
+invalidate_page adds the changed paths to the snapshot:dirty set, an
+incremental run only writes those. The snapshot:versions hash records
+the view key each file was written for, a full run writes the pages
+whose key differs, for example after a theme or template change.
+'''
+
+import os
+import tempfile
+
+from ukhra import APP
+from ukhra import view_cache_key
+import ukhra.lib as mmlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+DIRTY_KEY = 'snapshot:dirty'
+WORKING_KEY = 'snapshot:dirty:working'
+VERSIONS_KEY = 'snapshot:versions'
+
+
+def snapshot_file(root, path):
+    '''Returns the file name of the snapshot of the page.
+
+    :param root: Snapshot directory.
+    :param path: Path of the page.
+    :return: file name, or None if the path can not be written safely.
+    '''
+    parts = path.split(u'/')
+    if any(part in (u'', u'.', u'..') for part in parts):
+        return None
+    return os.path.join(root, 'page', *parts).encode('utf-8') + '.html'
+
+
+def write_atomic(filename, body):
+    '''Writes the file under a temporary name and renames it into place,
+    so the web server never sends half a page.'''
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.snapshot')
+    try:
+        with os.fdopen(fd, 'wb') as fobj:
+            fobj.write(body)
+        os.chmod(tmpname, 0644)
+        os.rename(tmpname, filename)
+    except Exception:
+        os.unlink(tmpname)
+        raise
+
+
+def remove(filename):
+    '''Removes the snapshot of a page which is gone or not public.'''
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+
+
+def write_pages(root, paths, client=None):
+    '''Writes the snapshots of the given pages.
+
+    :param root: Snapshot directory.
+    :param paths: list of page paths.
+    :param client: Flask test client, one is created if None.
+    :return: Number of files written.
+    '''
+    client = client or APP.test_client()
+    count = 0
+    keys = {}
+    for path in paths:
+        filename = snapshot_file(root, path)
+        if filename is None:
+            continue
+        page = mmlib.find_page(path, mmlib.VIEW_FIELDS)
+        if not page:
+            remove(filename)
+            keys[path] = None
+            continue
+        response = client.get(u'/page/%s' % path)
+        if response.status_code != 200:
+            remove(filename)
+            keys[path] = None
+            continue
+        write_atomic(filename, response.data)
+        keys[path] = view_cache_key(page)
+        count += 1
+    pipe = mmlib.redis.pipeline(transaction=False)
+    for path, key in keys.iteritems():
+        if key is None:
+            pipe.hdel(VERSIONS_KEY, path)
+        else:
+            pipe.hset(VERSIONS_KEY, path, key)
+    pipe.execute()
+    return count
+
+
+def update(root):
+    '''Writes the snapshots of the pages changed since the last run.
+
+    The dirty set is moved aside first, pages changed while this runs are
+    left for the next run. If a run dies, the next one picks up its pages.
+
+    :param root: Snapshot directory.
+    :return: Number of files written.
+    '''
+    pipe = mmlib.redis.pipeline()
+    pipe.sunionstore(WORKING_KEY, [WORKING_KEY, DIRTY_KEY])
+    pipe.delete(DIRTY_KEY)
+    pipe.execute()
+    paths = [path.decode('utf-8')
+             for path in mmlib.redis.smembers(WORKING_KEY)]
+    count = write_pages(root, paths)
+    mmlib.redis.delete(WORKING_KEY)
+    return count
+
+
+def update_all(root, batch_size=500):
+    '''Writes the snapshots of every page whose view changed.
+
+    :param root: Snapshot directory.
+    :param batch_size: Number of pages compared at once.
+    :return: tuple of the number of pages seen and of files written.
+    '''
+    client = APP.test_client()
+    seen = 0
+    count = 0
+    keys = (key for key in mmlib.redis.scan_iter('page:*'))
+    for batch in mmlib._batches(keys, batch_size):
+        paths = [key[5:].decode('utf-8') for key in batch]
+        pipe = mmlib.redis.pipeline(transaction=False)
+        for path in paths:
+            pipe.hmget('page:%s' % path, ('version', 'render_pending'))
+        pipe.hmget(VERSIONS_KEY, paths)
+        results = pipe.execute()
+        written = results.pop()
+        changed = []
+        for path, (version, pending), old in zip(paths, results, written):
+            page = {'version': mmlib.decode_page_field('version', version),
+                    'render_pending': mmlib.decode_page_field(
+                        'render_pending', pending)}
+            if view_cache_key(page) != old:
+                changed.append(path)
+        count += write_pages(root, changed, client)
+        seen += len(paths)
+    return seen, count